@@ -0,0 +1,365 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+import aio_pika
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+# Reuse the settings and the request contract of the Flask API
+from main import (
+    rabbitmq_host, rabbitmq_port, rabbitmq_vhost, rabbitmq_user, rabbitmq_pass,
+    rabbitmq_outbox_size, API_RETRY_AFTER, API_WAIT_TIMEOUT, NOTIFICATION_QUEUES, PRIORITY_QUEUE_ARGUMENTS,
+    PLAY_AUDIO_QUEUE, REPRODUCED_QUEUE, DEDUP_WINDOW_SECONDS, TRACKING_ENABLED, parse_notification,
+    check_duplicate, forget_duplicate, flush_duplicates, build_merged_messages, build_notification_message,
+    now_ms, start_trace, update_trace, forget_trace, get_trace, complete_traces,
+    REQUEST_SECONDS, PUBLISH_SECONDS, NOTIFICATIONS_RECEIVED, PUBLISH_FAILURES,
+    OUTBOX_MESSAGES, PUBLISHERS_CONNECTED
+)
+
+# Single multiplexed AMQP connection and confirm channel shared by every request
+connection = None
+channel = None
+
+# Messages handed to RabbitMQ and not confirmed yet, bounded by RABBITMQ_OUTBOX_SIZE
+outbox_pending = 0
+
+# Keep a reference to background publishes so they are not garbage collected
+background_tasks = set()
+
+# Report this process' outbox and connection instead of the Flask publisher's
+OUTBOX_MESSAGES.set_function(lambda: outbox_pending)
+PUBLISHERS_CONNECTED.set_function(lambda: 1 if connection is not None and not connection.is_closed else 0)
+
+async def connect_to_rabbitmq():
+    """Open the robust (auto-reconnecting) connection and declare the queues."""
+    global connection, channel
+
+    connection = await aio_pika.connect_robust(
+        host=rabbitmq_host,
+        port=rabbitmq_port,
+        virtualhost=rabbitmq_vhost or '/',
+        login=rabbitmq_user,
+        password=rabbitmq_pass,
+        client_properties={"connection_name": "Syrin REST API (ASGI)"}
+    )
+
+    # Publisher confirms let many publishes be in flight on the same channel
+    channel = await connection.channel(publisher_confirms=True)
+
+    for queue_name in NOTIFICATION_QUEUES + [PLAY_AUDIO_QUEUE]:
+        await channel.declare_queue(queue_name, durable=True, arguments=PRIORITY_QUEUE_ARGUMENTS)
+        logging.info(f"Queue '{queue_name}' checked or created.")
+
+    if TRACKING_ENABLED:
+        # Complete the traces from the final queue of the pipeline, on a channel of its own
+        tracker_channel = await connection.channel()
+        reproduced_queue = await tracker_channel.declare_queue(REPRODUCED_QUEUE, durable=True)
+        await reproduced_queue.consume(on_reproduced_message, no_ack=True)
+        logging.info(f"Tracker consuming '{REPRODUCED_QUEUE}'.")
+
+async def on_reproduced_message(message):
+    complete_traces(message.headers or {})
+
+async def publish_messages(messages):
+    """Publish (routing_key, body, priority, headers) concurrently and wait for every confirmation.
+
+    Returns one error message (or None when confirmed) per message.
+    """
+    global outbox_pending
+
+    async def publish(routing_key, body, priority, headers):
+        publish_started = time.perf_counter()
+        headers['x-syrin-api-enqueued'] = now_ms()
+        try:
+            await channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=body.encode(),
+                    content_type='application/json',
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,  # Makes the message persistent
+                    priority=priority,
+                    message_id=headers['x-syrin-message-id'],
+                    headers=headers
+                ),
+                routing_key=routing_key
+            )
+            PUBLISH_SECONDS.observe(time.perf_counter() - publish_started)
+            update_trace(headers, 'published')
+            return None
+        except Exception as e:
+            logging.error(f"Error publishing message to '{routing_key}': {str(e)}")
+            PUBLISH_FAILURES.labels(reason='nack').inc()
+            return "Message not confirmed by RabbitMQ"
+
+    try:
+        return await asyncio.gather(*(publish(*message) for message in messages))
+    finally:
+        outbox_pending -= len(messages)
+
+def enqueue_messages(messages):
+    """Start publishing the messages in the background.
+
+    Returns the publishing task, or None when too many messages are waiting for RabbitMQ.
+    """
+    global outbox_pending
+
+    if outbox_pending + len(messages) > rabbitmq_outbox_size:
+        logging.error(f"Outbox is full ({outbox_pending}/{rabbitmq_outbox_size} messages pending), {len(messages)} message(s) rejected.")
+        PUBLISH_FAILURES.labels(reason='outbox_full').inc(len(messages))
+        return None
+    outbox_pending += len(messages)
+
+    task = asyncio.create_task(publish_messages(messages))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def wait_for_task(task):
+    """Wait for the confirmations without cancelling the publish on timeout."""
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), API_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        PUBLISH_FAILURES.labels(reason='timeout').inc()
+        return None
+
+def enqueue_merged(merged):
+    """Start publishing the merged notifications, forgetting their traces if too many are waiting."""
+    messages = build_merged_messages(merged)
+    if messages and enqueue_messages(messages) is None:
+        logging.error(f"Dropped {len(messages)} merged notification(s): outbox is full.")
+        for _, _, _, headers in messages:
+            forget_trace(headers)
+
+async def dedup_flush_loop():
+    """Publish the merged notifications even when no new request arrives."""
+    while True:
+        await asyncio.sleep(1)
+        enqueue_merged(flush_duplicates())
+
+def count_status(results, status):
+    return sum(1 for result in results if result["status"] == status)
+
+def wait_requested(request):
+    return request.query_params.get('wait', '').lower() in ('true', '1', 'yes')
+
+def retry_response(body, status):
+    return JSONResponse(body, status_code=status, headers={'Retry-After': str(API_RETRY_AFTER)})
+
+def outbox_full_response(body):
+    """429 when the broker is just slower than the senders, 503 when it is unreachable."""
+    connected = connection is not None and not connection.is_closed
+    return retry_response(body, 429 if connected else 503)
+
+async def read_batch_items(request):
+    """Yield (payload, error) for a JSON array or an NDJSON stream body."""
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+
+    if content_type in ('application/x-ndjson', 'application/jsonl'):
+        buffer = b''
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield parse_line(line)
+        if buffer.strip():
+            yield parse_line(buffer)
+        return
+
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        data = None
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array or an NDJSON body")
+
+    for item in data:
+        yield item, None
+
+def parse_line(line):
+    try:
+        return json.loads(line), None
+    except ValueError:
+        return None, "Invalid JSON"
+
+async def text_to_speech(request):
+    received = now_ms()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+
+    # Log the received request data
+    logging.info(f"Request received with data: {data}")
+
+    notification = parse_notification(data)
+    if not notification:
+        logging.error("No text or message provided")
+        return JSONResponse({"error": "No text or message provided"}, status_code=400)
+
+    text, level, field_source = notification
+    NOTIFICATIONS_RECEIVED.labels(level=level, field_source=field_source).inc()
+
+    # Publish the merged notifications whose window is over, then skip repeats
+    duplicate, merged = check_duplicate(text, level)
+    if merged:
+        enqueue_merged(merged)
+    if duplicate:
+        logging.info(f"Duplicate notification from field '{field_source}' suppressed.")
+        return JSONResponse({"message": f"Request received from field '{field_source}', duplicate of a recent notification."})
+
+    # The audio cache lookup may hit MinIO, keep it off the event loop
+    headers = start_trace(level, received)
+    message_id = headers['x-syrin-message-id']
+    message, cached = await asyncio.get_running_loop().run_in_executor(None, build_notification_message, text, level, headers)
+
+    task = enqueue_messages([message])
+    if task is None:
+        forget_duplicate(text, level)
+        forget_trace(headers)
+        return outbox_full_response({"error": "Too many pending messages, try again later"})
+
+    if wait_requested(request):
+        errors = await wait_for_task(task)
+        error = "Timed out waiting for RabbitMQ to confirm the message" if errors is None else errors[0]
+        if error:
+            logging.error(f"Message from field '{field_source}' not confirmed: {error}")
+            return retry_response({"error": error, "message_id": message_id}, 503)
+        return JSONResponse({"message": f"Request received from field '{field_source}', message confirmed by RabbitMQ.", "message_id": message_id, "cached": cached})
+
+    # Respond immediately that the processing has been queued
+    if cached:
+        return JSONResponse({"message": f"Request received from field '{field_source}', cached audio queued for playback.", "message_id": message_id, "cached": True})
+    return JSONResponse({"message": f"Request received from field '{field_source}', processing in progress.", "message_id": message_id})
+
+async def text_to_speech_status(request):
+    trace = get_trace(request.path_params['message_id'])
+    if trace is None:
+        return JSONResponse({"error": "Unknown message id"}, status_code=404)
+    return JSONResponse(trace)
+
+async def text_to_speech_batch(request):
+    received = now_ms()
+    results = []
+    notifications = []
+    messages = []
+    merged = []
+
+    try:
+        index = 0
+        async for data, error in read_batch_items(request):
+            notification = parse_notification(data) if error is None else None
+            if not notification:
+                results.append({"index": index, "status": "rejected", "error": error or "No text or message provided"})
+            else:
+                text, level, field_source = notification
+                NOTIFICATIONS_RECEIVED.labels(level=level, field_source=field_source).inc()
+                duplicate, expired = check_duplicate(text, level)
+                merged += expired
+                if duplicate:
+                    results.append({"index": index, "status": "suppressed", "field_source": field_source, "level": level})
+                else:
+                    headers = start_trace(level, received)
+                    message, cached = await asyncio.get_running_loop().run_in_executor(None, build_notification_message, text, level, headers)
+                    notifications.append((text, level))
+                    messages.append(message)
+                    results.append({"index": index, "status": "queued", "message_id": headers['x-syrin-message-id'], "field_source": field_source, "level": level, "cached": cached})
+            index += 1
+    except ValueError as e:
+        logging.error(f"Invalid batch request: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    logging.info(f"Batch request received with {len(results)} item(s), {len(messages)} valid.")
+
+    if merged:
+        enqueue_merged(merged)
+
+    if not messages:
+        return JSONResponse({"queued": 0, "rejected": count_status(results, "rejected"), "results": results})
+
+    # A batch larger than the whole outbox would never fit, retrying it would not help
+    too_large = len(messages) > rabbitmq_outbox_size
+
+    task = None if too_large else enqueue_messages(messages)
+    if task is None:
+        for text, level in notifications:
+            forget_duplicate(text, level)
+        for message in messages:
+            forget_trace(message[3])
+        if too_large:
+            error = f"Batch too large: {len(messages)} valid items, at most {rabbitmq_outbox_size} are accepted per request"
+        else:
+            error = "Too many pending messages, try again later"
+        for result in results:
+            if result["status"] == "queued":
+                result.pop("message_id")
+                result.update(status="rejected", error=error)
+        body = {"queued": 0, "rejected": count_status(results, "rejected"), "results": results}
+        if too_large:
+            logging.error(f"Batch rejected: {error}")
+            PUBLISH_FAILURES.labels(reason='too_large').inc(len(messages))
+            return JSONResponse(body, status_code=413)
+        return outbox_full_response(body)
+
+    if wait_requested(request):
+        errors = await wait_for_task(task)
+        if errors is None:
+            errors = ["Timed out waiting for RabbitMQ to confirm the message"] * len(messages)
+        queued = [result for result in results if result["status"] == "queued"]
+        for result, error in zip(queued, errors):
+            if error:
+                result.update(status="failed", error=error)
+            else:
+                result["status"] = "confirmed"
+        confirmed = sum(1 for error in errors if not error)
+        if confirmed < len(queued):
+            logging.error(f"Batch not fully confirmed: {len(queued) - confirmed} message(s) failed")
+            return retry_response({"queued": len(queued), "confirmed": confirmed, "rejected": count_status(results, "rejected"), "results": results}, 503)
+
+    return JSONResponse({"queued": len(messages), "rejected": count_status(results, "rejected"), "results": results})
+
+def timed(endpoint):
+    """Record the handling time of a request in the request histogram."""
+    def decorator(handler):
+        async def wrapper(request):
+            started = time.perf_counter()
+            response = await handler(request)
+            REQUEST_SECONDS.labels(endpoint=endpoint, status=response.status_code).observe(time.perf_counter() - started)
+            return response
+        return wrapper
+    return decorator
+
+async def metrics(request):
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await connect_to_rabbitmq()
+    flush_task = asyncio.create_task(dedup_flush_loop()) if DEDUP_WINDOW_SECONDS > 0 else None
+    try:
+        yield
+    finally:
+        if flush_task:
+            flush_task.cancel()
+        # Let in-flight publishes finish before closing the connection
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        await connection.close()
+        logging.info("Connection to RabbitMQ closed.")
+
+app = Starlette(
+    routes=[
+        Route('/api/text-to-speech', timed('/api/text-to-speech')(text_to_speech), methods=['POST']),
+        Route('/api/text-to-speech/batch', timed('/api/text-to-speech/batch')(text_to_speech_batch), methods=['POST']),
+        Route('/api/text-to-speech/{message_id}', timed('/api/text-to-speech/{message_id}')(text_to_speech_status), methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5121)
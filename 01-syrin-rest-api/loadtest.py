@@ -0,0 +1,343 @@
+"""Load generator for the Syrin REST API ingest path.
+
+Drives /api/text-to-speech (or the batch endpoint) at a fixed request rate with
+optional bursts, and reports latency percentiles, error rate and the achieved
+RabbitMQ publish throughput.
+
+It runs either against a deployed API (--url) or against the API started in
+this process (Flask or ASGI), publishing to the real RabbitMQ configured in the
+environment or to an in-process AMQP stand-in (--broker stub).
+
+    python loadtest.py --rps 200 --duration 30 --burst-every 10 --burst-size 500
+    python loadtest.py --app asgi --broker stub --publish-latency 2
+    python loadtest.py --url http://syrin-api:30008 --rps 100 --json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app')
+
+
+class StandInBroker:
+    """Counts the messages the API publishes, with a configurable confirm or commit latency."""
+
+    def __init__(self, publish_latency):
+        self.publish_latency = publish_latency
+        self.lock = threading.Lock()
+        self.published = 0
+        self.first_publish = None
+        self.last_publish = None
+
+    def record(self):
+        now = time.perf_counter()
+        with self.lock:
+            self.published += 1
+            if self.first_publish is None:
+                self.first_publish = now
+            self.last_publish = now
+
+    def install_pika(self):
+        """Replace pika.BlockingConnection with an in-process stand-in."""
+        import pika
+        broker = self
+
+        class StandInChannel:
+            def queue_declare(self, **kwargs):
+                pass
+
+            def __init__(self):
+                self.uncommitted = 0
+
+            def tx_select(self):
+                pass
+
+            def tx_commit(self):
+                time.sleep(broker.publish_latency)
+                for _ in range(self.uncommitted):
+                    broker.record()
+                self.uncommitted = 0
+
+            def basic_qos(self, **kwargs):
+                pass
+
+            def basic_publish(self, **kwargs):
+                self.uncommitted += 1
+
+            def basic_consume(self, **kwargs):
+                pass
+
+            def start_consuming(self):
+                # Nothing ever reaches the end of the pipeline
+                threading.Event().wait()
+
+        class StandInConnection:
+            def __init__(self, parameters):
+                self.is_open = True
+                self.is_closed = False
+
+            def channel(self):
+                return StandInChannel()
+
+            def process_data_events(self, time_limit=0):
+                pass
+
+            def close(self):
+                self.is_open = False
+                self.is_closed = True
+
+        pika.BlockingConnection = StandInConnection
+
+    def install_aio_pika(self):
+        """Replace aio_pika.connect_robust with an in-process stand-in."""
+        import asyncio
+        import aio_pika
+        broker = self
+
+        class StandInExchange:
+            async def publish(self, message, routing_key):
+                await asyncio.sleep(broker.publish_latency)
+                broker.record()
+
+        class StandInQueue:
+            async def consume(self, callback, **kwargs):
+                pass
+
+        class StandInChannel:
+            default_exchange = StandInExchange()
+
+            async def declare_queue(self, *args, **kwargs):
+                return StandInQueue()
+
+        class StandInConnection:
+            is_closed = False
+
+            async def channel(self, **kwargs):
+                return StandInChannel()
+
+            async def close(self):
+                self.is_closed = True
+
+        async def connect_robust(**kwargs):
+            return StandInConnection()
+
+        aio_pika.connect_robust = connect_robust
+
+
+def start_local_api(app_kind, port):
+    """Start the API from ./app in a background thread and return its base URL."""
+    sys.path.insert(0, APP_DIR)
+
+    if app_kind == 'flask':
+        from werkzeug.serving import make_server
+        import main
+        server = make_server('127.0.0.1', port, main.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        import uvicorn
+        import asgi
+        server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=port, log_level='warning'))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+
+    # The API logs every request at INFO level, keep the report readable
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    return f"http://127.0.0.1:{port}"
+
+
+def build_payload(sequence, args):
+    """Mixed Uptime Kuma ('msg') and generic ('text') alerts."""
+    alert = sequence % args.distinct if args.distinct else sequence
+    if random.random() < args.msg_ratio:
+        return {"msg": f"[web-{alert:05d}] [DOWN] Connection refused"}
+    return {"text": f"Disk usage on db-{alert:05d} above 90%"}
+
+
+def send_request(base_url, args, sequence):
+    """POST one request and return (status, error) where status 0 means no response."""
+    if args.batch_size > 1:
+        body = [build_payload(sequence * args.batch_size + i, args) for i in range(args.batch_size)]
+        path = '/api/text-to-speech/batch'
+    else:
+        body = build_payload(sequence, args)
+        path = '/api/text-to-speech'
+    if args.wait:
+        path += '?wait=true'
+
+    request = urllib.request.Request(
+        base_url + path,
+        data=json.dumps(body).encode(),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            response.read()
+            return response.status, None
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except Exception as e:
+        return 0, type(e).__name__
+
+
+def read_published_count(base_url):
+    """Number of confirmed publishes reported by the API's /metrics, or None."""
+    try:
+        with urllib.request.urlopen(base_url + '/metrics', timeout=5) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith('syrin_api_publish_seconds_count'):
+                    return float(line.split()[-1])
+    except Exception:
+        return None
+    return None
+
+
+def schedule(args):
+    """Offsets (in seconds from the start) at which requests are sent."""
+    offsets = []
+    interval = 1.0 / args.rps
+    t = 0.0
+    while t < args.duration:
+        offsets.append(t)
+        t += interval
+
+    if args.burst_every and args.burst_size:
+        burst = args.burst_every
+        while burst < args.duration:
+            offsets.extend([burst] * args.burst_size)
+            burst += args.burst_every
+
+    return sorted(offsets)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run(args):
+    broker = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        if args.broker == 'stub':
+            broker = StandInBroker(args.publish_latency / 1000.0)
+            broker.install_pika() if args.app == 'flask' else broker.install_aio_pika()
+        base_url = start_local_api(args.app, args.port)
+
+    published_before = read_published_count(base_url)
+
+    offsets = schedule(args)
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def fire(sequence, scheduled_at):
+        status, error = send_request(base_url, args, sequence)
+        # Measure from the scheduled time so a slow API cannot hide its queueing delay
+        latency = time.perf_counter() - scheduled_at
+        with lock:
+            latencies.append(latency)
+            key = error or status
+            statuses[key] = statuses.get(key, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for sequence, offset in enumerate(offsets):
+            scheduled_at = started + offset
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(fire, sequence, scheduled_at)
+    elapsed = time.perf_counter() - started
+
+    # Give the publisher time to drain the outbox before measuring throughput
+    time.sleep(args.drain)
+
+    latencies.sort()
+    total = len(latencies)
+    ok = sum(count for status, count in statuses.items() if status == 200)
+    report = {
+        "target": base_url,
+        "requests": total,
+        "messages_per_request": args.batch_size,
+        "duration_seconds": round(elapsed, 3),
+        "achieved_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "error_rate": round((total - ok) / total, 4) if total else 0.0,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+    }
+
+    if broker is not None:
+        window = (broker.last_publish - broker.first_publish) if broker.published > 1 else 0
+        report["published"] = broker.published
+        report["publish_throughput"] = round(broker.published / window, 1) if window else None
+    else:
+        published_after = read_published_count(base_url)
+        if published_before is not None and published_after is not None:
+            report["published"] = int(published_after - published_before)
+            report["publish_throughput"] = round(report["published"] / (elapsed + args.drain), 1)
+
+    return report
+
+
+def print_report(report):
+    print(f"Target:            {report['target']}")
+    print(f"Requests:          {report['requests']} ({report['messages_per_request']} message(s) each) in {report['duration_seconds']} s")
+    print(f"Achieved rate:     {report['achieved_rps']} req/s")
+    print(f"Error rate:        {report['error_rate'] * 100:.2f}%  {report['statuses']}")
+    latency = report['latency_ms']
+    print(f"Latency (ms):      p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    if "published" in report:
+        print(f"Published:         {report['published']} message(s), {report['publish_throughput']} msg/s")
+    else:
+        print("Published:         unknown (the target does not expose /metrics)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test for the Syrin REST API ingest path.")
+    parser.add_argument('--url', help="Base URL of a running API. Without it the API is started in this process.")
+    parser.add_argument('--app', choices=['flask', 'asgi'], default='flask', help="API started in this process (default: flask).")
+    parser.add_argument('--broker', choices=['stub', 'rabbitmq'], default='stub', help="In-process stand-in or the RabbitMQ configured in the environment (default: stub).")
+    parser.add_argument('--publish-latency', type=float, default=1.0, help="Stand-in broker confirm (ASGI) or commit (Flask) latency in ms (default: 1).")
+    parser.add_argument('--port', type=int, default=5199, help="Port of the API started in this process (default: 5199).")
+    parser.add_argument('--rps', type=float, default=100, help="Steady request rate (default: 100).")
+    parser.add_argument('--duration', type=float, default=10, help="Test duration in seconds (default: 10).")
+    parser.add_argument('--burst-every', type=float, default=0, help="Send a burst every N seconds (default: no bursts).")
+    parser.add_argument('--burst-size', type=int, default=0, help="Requests sent at once in each burst.")
+    parser.add_argument('--msg-ratio', type=float, default=0.5, help="Fraction of 'msg' (error) payloads, the rest are 'text' (default: 0.5).")
+    parser.add_argument('--distinct', type=int, default=0, help="Number of distinct alert texts, 0 for all unique (default: 0).")
+    parser.add_argument('--batch-size', type=int, default=1, help="Messages per request, more than 1 uses the batch endpoint (default: 1).")
+    parser.add_argument('--wait', action='store_true', help="Send wait=true and measure until the broker confirms.")
+    parser.add_argument('--concurrency', type=int, default=200, help="Maximum requests in flight (default: 200).")
+    parser.add_argument('--timeout', type=float, default=30, help="Request timeout in seconds (default: 30).")
+    parser.add_argument('--drain', type=float, default=2, help="Seconds to wait for the outbox to drain after the last request (default: 2).")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
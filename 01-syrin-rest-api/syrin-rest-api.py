@@ -1,9 +1,18 @@
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import threading
+import queue
+import time
 import os
 import pika
 import json  # Import the JSON library
+import hashlib
+import uuid
+import urllib3
+from collections import OrderedDict
+from minio import Minio
+from minio.error import S3Error
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 # Configure logging at INFO level
 logging.basicConfig(level=logging.INFO)
@@ -18,89 +27,800 @@ rabbitmq_vhost = os.getenv('RABBITMQ_VHOST', '')
 rabbitmq_user = os.getenv('RABBITMQ_USER', '')
 rabbitmq_pass = os.getenv('RABBITMQ_PASS', '')
 
-app = Flask(__name__)
+# Load publisher settings: connections per worker, outbox capacity, messages per commit and reconnect delay
+rabbitmq_publisher_connections = int(os.getenv('RABBITMQ_PUBLISHER_CONNECTIONS', 1))
+rabbitmq_outbox_size = int(os.getenv('RABBITMQ_OUTBOX_SIZE', 10000))  # messages
+rabbitmq_publish_group_size = int(os.getenv('RABBITMQ_PUBLISH_GROUP_SIZE', 500))  # messages
+rabbitmq_reconnect_delay = int(os.getenv('RABBITMQ_RECONNECT_DELAY', 5))  # seconds
 
-def declare_queues():
-    """Function to declare the necessary queues when starting Flask."""
-    # Connect to RabbitMQ
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    parameters = pika.ConnectionParameters(
-        host=rabbitmq_host,
-        port=rabbitmq_port,
-        virtual_host=rabbitmq_vhost,
-        credentials=credentials
+# Priority queues: errors overtake warnings at every stage (0 disables priorities)
+rabbitmq_max_priority = int(os.getenv('RABBITMQ_MAX_PRIORITY', 10))
+
+# Load backpressure settings for the API responses
+API_RETRY_AFTER = int(os.getenv('API_RETRY_AFTER', 5))  # seconds
+API_WAIT_TIMEOUT = float(os.getenv('API_WAIT_TIMEOUT', 10))  # seconds
+
+# Load alert-storm deduplication settings (a window of 0 disables it)
+DEDUP_WINDOW_SECONDS = float(os.getenv('DEDUP_WINDOW_SECONDS', 0))
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'merge')  # 'merge' or 'suppress'
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 10000))
+
+# Load audio cache settings (MinIO holds the already rendered audios)
+AUDIO_CACHE_ENABLED = os.getenv('AUDIO_CACHE_ENABLED', 'false').lower() == 'true'
+AUDIO_CACHE_PREFIX = os.getenv('AUDIO_CACHE_PREFIX', 'cache/')
+AUDIO_CACHE_INDEX_SIZE = int(os.getenv('AUDIO_CACHE_INDEX_SIZE', 10000))
+AUDIO_CACHE_INDEX_TTL = int(os.getenv('AUDIO_CACHE_INDEX_TTL', 3600))  # seconds
+AUDIO_CACHE_MISS_TTL = int(os.getenv('AUDIO_CACHE_MISS_TTL', 30))  # seconds a miss is remembered
+AUDIO_CACHE_TIMEOUT = float(os.getenv('AUDIO_CACHE_TIMEOUT', 0.5))  # seconds to connect to and read from MinIO
+AUDIO_CACHE_BACKOFF = int(os.getenv('AUDIO_CACHE_BACKOFF', 30))  # seconds the cache is skipped after a MinIO error
+
+# Load end-to-end tracking settings (the tracker consumes the final queue of the pipeline)
+TRACKING_ENABLED = os.getenv('TRACKING_ENABLED', 'true').lower() == 'true'
+TRACE_MAX_ENTRIES = int(os.getenv('TRACE_MAX_ENTRIES', 10000))
+
+# Load MinIO settings from environment variables
+MINIO_URL = os.getenv('MINIO_URL', '')
+MINIO_PORT = int(os.getenv('MINIO_PORT', 9000))
+MINIO_ROOT_USER = os.getenv('MINIO_ROOT_USER', '')
+MINIO_ROOT_PASSWORD = os.getenv('MINIO_ROOT_PASSWORD', '')
+MINIO_BUCKET_WORK = os.getenv('MINIO_BUCKET_WORK', 'syrin')
+
+# Queues used by the API
+NOTIFICATION_QUEUES = ['000_notification_warning', '000_notification_error']
+PLAY_AUDIO_QUEUE = '003_notification_process_play_audio'
+REPRODUCED_QUEUE = '004_notification_process_audio_reproduced'
+
+# Arguments of the processing queues, identical in every Syrin service
+PRIORITY_QUEUE_ARGUMENTS = {'x-max-priority': rabbitmq_max_priority} if rabbitmq_max_priority > 0 else None
+
+# In-process outbox shared by the request handlers and the publisher, bounded by
+# the number of messages waiting for a broker confirmation
+outbox = queue.Queue()
+outbox_pending = 0
+outbox_lock = threading.Lock()
+
+# PID of the process that owns the running publisher (gunicorn forks the workers)
+publisher_pid = None
+publisher_lock = threading.Lock()
+
+# Number of publishers currently connected to RabbitMQ
+publishers_connected = 0
+
+# Notifications seen inside the deduplication window, oldest first:
+# (normalized text, level) -> {"text", "level", "first_seen", "repeats"}
+dedup_index = OrderedDict()
+dedup_lock = threading.Lock()
+
+# Local index of the cached audios found in MinIO: cache key -> (object name, expiry)
+audio_cache_index = OrderedDict()
+audio_cache_lock = threading.Lock()
+audio_cache_unavailable_until = 0  # monotonic time until which MinIO is not asked
+
+# Recent notifications followed through the pipeline, oldest first:
+# message id -> {"status", "level", "headers"}
+traces = OrderedDict()
+trace_lock = threading.Lock()
+
+# Time spent in each part of the pipeline, from the x-syrin-* timestamps:
+# (segment, start events in order of preference, end event)
+TRACE_SEGMENTS = [
+    ('api', ['api-received'], 'api-enqueued'),
+    ('humanization_queue', ['api-enqueued'], 'humanization-started'),
+    ('humanization', ['humanization-started'], 'humanization-finished'),
+    ('make_audio_queue', ['humanization-enqueued'], 'make-audio-started'),
+    ('synthesis', ['make-audio-started'], 'make-audio-synthesized'),
+    ('upload', ['make-audio-synthesized'], 'make-audio-finished'),
+    ('speak_queue', ['make-audio-enqueued', 'api-enqueued'], 'speak-started'),
+    ('download', ['speak-started'], 'speak-downloaded'),
+    ('playback', ['speak-downloaded'], 'speak-played'),
+    ('total', ['api-received'], 'speak-finished'),
+]
+
+# Connect to MinIO only when the audio cache is used. Lookups run on the request path,
+# so they get short timeouts and no retries: a slow MinIO costs a miss, not a stalled request
+minio_client = Minio(
+    f"{MINIO_URL}:{MINIO_PORT}",
+    access_key=MINIO_ROOT_USER,
+    secret_key=MINIO_ROOT_PASSWORD,
+    secure=False,
+    http_client=urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=AUDIO_CACHE_TIMEOUT, read=AUDIO_CACHE_TIMEOUT),
+        retries=False,
+        maxsize=10
     )
+) if AUDIO_CACHE_ENABLED else None
 
-    connection = pika.BlockingConnection(parameters)
-    channel = connection.channel()
+# Prometheus metrics of the ingest path
+REQUEST_SECONDS = Histogram('syrin_api_request_seconds', 'Time spent handling API requests', ['endpoint', 'status'])
+PUBLISH_SECONDS = Histogram('syrin_api_publish_seconds', 'Time for RabbitMQ to accept and commit one batch of messages')
+NOTIFICATIONS_RECEIVED = Counter('syrin_api_notifications_total', 'Notifications received', ['level', 'field_source'])
+PUBLISH_FAILURES = Counter('syrin_api_publish_failures_total', 'Messages not published to RabbitMQ', ['reason'])
+DUPLICATES_SUPPRESSED = Counter('syrin_api_duplicates_suppressed_total', 'Notifications suppressed by the deduplication window')
+AUDIO_CACHE_LOOKUPS = Counter('syrin_api_audio_cache_lookups_total', 'Audio cache lookups', ['result'])
+OUTBOX_MESSAGES = Gauge('syrin_api_outbox_messages', 'Messages waiting for a RabbitMQ confirmation')
+PUBLISHERS_CONNECTED = Gauge('syrin_api_publishers_connected', 'Publishers connected to RabbitMQ')
+OUTBOX_MESSAGES.set_function(lambda: outbox_pending)
+PUBLISHERS_CONNECTED.set_function(lambda: publishers_connected)
+
+app = Flask(__name__)
 
-    # Declare the queues to ensure they exist
-    queues = ['000_notification_warning', '000_notification_error']
-    for queue in queues:
-        channel.queue_declare(queue=queue, durable=True)
-        logging.info(f"Queue '{queue}' checked or created.")
+class OutboxBatch:
+    """Messages published together, plus the result of the broker confirmation."""
 
-    connection.close()
+    def __init__(self, messages):
+        self.messages = messages  # list of (routing_key, body, priority, headers)
+        self.published = 0  # messages committed by the broker
+        self.error = None
+        self.done = threading.Event()
 
-def send_text_to_queue(text, level):
-    # Connect to RabbitMQ
+def get_connection_parameters(connection_name):
+    """Build the RabbitMQ connection parameters with the given connection name."""
     credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    parameters = pika.ConnectionParameters(
+
+    # Set client properties, including connection name
+    client_properties = {
+        "connection_name": connection_name
+    }
+
+    return pika.ConnectionParameters(
         host=rabbitmq_host,
         port=rabbitmq_port,
         virtual_host=rabbitmq_vhost,
-        credentials=credentials
+        credentials=credentials,
+        client_properties=client_properties
     )
 
-    connection = pika.BlockingConnection(parameters)
+def declare_queues(channel):
+    """Declare the necessary queues on the given channel."""
+    for queue_name in NOTIFICATION_QUEUES + [PLAY_AUDIO_QUEUE]:
+        channel.queue_declare(queue=queue_name, durable=True, arguments=PRIORITY_QUEUE_ARGUMENTS)
+        logging.info(f"Queue '{queue_name}' checked or created.")
+
+def open_publisher_channel(index):
+    """Open a long-lived publisher connection in transactional mode."""
+    connection = pika.BlockingConnection(get_connection_parameters(f"Syrin REST API Publisher {index}"))
     channel = connection.channel()
+    declare_queues(channel)
 
-    # Construct the message in JSON format
-    message = json.dumps({"text": text, "level": level})
-
-    # Send the text to the corresponding queue
-    channel.basic_publish(
-        exchange='',
-        routing_key='000_notification_' + level,
-        body=message,
-        properties=pika.BasicProperties(
-            delivery_mode=2,  # Makes the message persistent
-        )
-    )
+    # Publishes are buffered by the broker until tx_commit, which returns once
+    # the whole batch is accepted: one round trip per batch instead of per message
+    channel.tx_select()
+    return connection, channel
+
+def close_connection(connection):
+    try:
+        if connection and connection.is_open:
+            connection.close()
+    except Exception as e:
+        logging.error(f"Error closing RabbitMQ connection: {str(e)}")
+
+def set_publisher_connected(connected):
+    global publishers_connected
+
+    with outbox_lock:
+        publishers_connected += 1 if connected else -1
+
+def finish_batch(batch, error=None):
+    """Release the batch from the outbox and wake up any request waiting for it."""
+    global outbox_pending
+
+    with outbox_lock:
+        outbox_pending -= len(batch.messages)
+
+    batch.error = error
+    batch.done.set()
+    outbox.task_done()
+
+def take_batches():
+    """Wait for a batch in the outbox and group it with the batches queued behind it.
+
+    Raises queue.Empty when nothing arrives within a second.
+    """
+    batches = [outbox.get(timeout=1)]
+    size = len(batches[0].messages)
+
+    while size < rabbitmq_publish_group_size:
+        try:
+            batch = outbox.get_nowait()
+        except queue.Empty:
+            break
+        batches.append(batch)
+        size += len(batch.messages)
+    return batches
+
+def publisher_loop(index):
+    """Publish the batches from the outbox over a connection owned by this thread.
+
+    The batches waiting in the outbox are grouped, up to RABBITMQ_PUBLISH_GROUP_SIZE
+    messages, and committed together, so a burst costs one broker round trip per
+    group instead of one per request. The connection is opened once and reused;
+    if it drops, the broker discards the uncommitted transaction and the whole
+    group is published again after reconnecting.
+    """
+    connection = None
+    channel = None
+    pending = []
+
+    while True:
+        if connection is None or not connection.is_open:
+            try:
+                connection, channel = open_publisher_channel(index)
+                set_publisher_connected(True)
+                logging.info(f"Publisher {index} connected to RabbitMQ.")
+            except Exception as e:
+                logging.error(f"Publisher {index} failed to connect to RabbitMQ: {str(e)}")
+                connection = None
+                time.sleep(rabbitmq_reconnect_delay)
+                continue
+
+        if not pending:
+            try:
+                pending = take_batches()
+            except queue.Empty:
+                # Nothing to publish, keep the connection (heartbeats) alive
+                try:
+                    connection.process_data_events(time_limit=0)
+                except Exception as e:
+                    logging.error(f"Publisher {index} lost the connection to RabbitMQ: {str(e)}")
+                    close_connection(connection)
+                    set_publisher_connected(False)
+                    connection = None
+                continue
+
+        messages = [message for batch in pending for message in batch.messages]
+        try:
+            # Publish the group back to back without waiting, then commit it once
+            publish_started = time.perf_counter()
+            for routing_key, message, priority, headers in messages:
+                headers['x-syrin-api-enqueued'] = now_ms()
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=message,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # Makes the message persistent
+                        priority=priority,
+                        message_id=headers['x-syrin-message-id'],
+                        headers=headers
+                    )
+                )
+            channel.tx_commit()
+            PUBLISH_SECONDS.observe(time.perf_counter() - publish_started)
+
+            for routing_key, message, priority, headers in messages:
+                update_trace(headers, 'published')
+            for batch in pending:
+                batch.published = len(batch.messages)
+                finish_batch(batch)
+            pending = []
+        except Exception as e:
+            logging.error(f"Publisher {index} failed to publish, retrying {len(messages)} message(s) after reconnect: {str(e)}")
+            PUBLISH_FAILURES.labels(reason='connection').inc()
+            close_connection(connection)
+            set_publisher_connected(False)
+            connection = None
+
+def complete_traces(headers):
+    """Record the timestamps collected by every stage once speak is done with a message."""
+    if 'x-syrin-message-id' not in headers:
+        return
+
+    status = 'played' if 'x-syrin-speak-played' in headers else 'failed'
+    update_trace(headers, status)
+
+    # A humanization summary carries the ids of every notification it replaced
+    for message_id in headers.get('x-syrin-batched-message-ids') or []:
+        if message_id != headers['x-syrin-message-id']:
+            update_trace(dict(headers, **{'x-syrin-message-id': message_id}), status)
+
+def on_reproduced_message(channel, method_frame, header_frame, body):
+    complete_traces(header_frame.headers or {})
+
+def tracker_loop():
+    """Consume the final queue of the pipeline to complete the traces."""
+    while True:
+        connection = None
+        try:
+            connection = pika.BlockingConnection(get_connection_parameters("Syrin REST API Tracker"))
+            channel = connection.channel()
+            channel.queue_declare(queue=REPRODUCED_QUEUE, durable=True)
+            channel.basic_consume(queue=REPRODUCED_QUEUE, on_message_callback=on_reproduced_message, auto_ack=True)
+            logging.info(f"Tracker consuming '{REPRODUCED_QUEUE}'.")
+            channel.start_consuming()
+        except Exception as e:
+            logging.error(f"Tracker lost the connection to RabbitMQ: {str(e)}")
+        finally:
+            close_connection(connection)
+        time.sleep(rabbitmq_reconnect_delay)
+
+def start_publisher():
+    """Start the publisher threads once per worker process."""
+    global publisher_pid
+
+    with publisher_lock:
+        if publisher_pid == os.getpid():
+            return
+
+        for index in range(rabbitmq_publisher_connections):
+            threading.Thread(target=publisher_loop, args=(index,), name=f"publisher-{index}", daemon=True).start()
+
+        if DEDUP_WINDOW_SECONDS > 0:
+            threading.Thread(target=dedup_flush_loop, name="dedup-flush", daemon=True).start()
+
+        if TRACKING_ENABLED:
+            threading.Thread(target=tracker_loop, name="tracker", daemon=True).start()
+
+        publisher_pid = os.getpid()
+        logging.info(f"Started {rabbitmq_publisher_connections} RabbitMQ publisher(s) with an outbox of {rabbitmq_outbox_size} messages.")
+
+def enqueue_messages(messages):
+    """Hand a list of (routing_key, body, priority, headers) to the publisher as a single batch.
+
+    Returns the OutboxBatch, or None when the outbox has no room for the messages.
+    """
+    global outbox_pending
+
+    start_publisher()
+
+    with outbox_lock:
+        if outbox_pending + len(messages) > rabbitmq_outbox_size:
+            logging.error(f"Outbox is full ({outbox_pending}/{rabbitmq_outbox_size} messages pending), {len(messages)} message(s) rejected.")
+            PUBLISH_FAILURES.labels(reason='outbox_full').inc(len(messages))
+            return None
+        outbox_pending += len(messages)
+
+    batch = OutboxBatch(messages)
+    outbox.put(batch)
+    return batch
+
+def get_priority(level):
+    """Map the message level to an AMQP priority."""
+    if rabbitmq_max_priority <= 0:
+        return None
+    return rabbitmq_max_priority if level == 'error' else 1
+
+def now_ms():
+    """Epoch timestamp in milliseconds, as used in the x-syrin-* trace headers."""
+    return int(time.time() * 1000)
+
+def start_trace(level, received=None):
+    """Assign a message id to a new notification and start following it.
+
+    Returns the AMQP headers that every stage copies and completes with its own timestamps.
+    """
+    headers = {'x-syrin-message-id': uuid.uuid4().hex, 'x-syrin-api-received': received or now_ms()}
+
+    with trace_lock:
+        traces[headers['x-syrin-message-id']] = {"status": "queued", "level": level, "headers": dict(headers)}
+        while len(traces) > TRACE_MAX_ENTRIES:
+            traces.popitem(last=False)
+
+    return headers
+
+def update_trace(headers, status):
+    """Store the latest timestamps and status of a notification."""
+    message_id = headers['x-syrin-message-id']
+
+    with trace_lock:
+        trace = traces.get(message_id)
+        if trace is None:
+            # Published by another worker or before a restart, the headers hold the whole story
+            trace = traces[message_id] = {"status": status, "level": None, "headers": {}}
+            while len(traces) > TRACE_MAX_ENTRIES:
+                traces.popitem(last=False)
+        trace["status"] = status
+        trace["headers"].update(headers)
+
+def forget_trace(headers):
+    """Stop following notifications that could not be queued."""
+    with trace_lock:
+        traces.pop(headers['x-syrin-message-id'], None)
+
+def get_trace(message_id):
+    """Return the status, timestamps and per-segment durations of a notification, or None."""
+    with trace_lock:
+        trace = traces.get(message_id)
+        if trace is None:
+            return None
+        status, level, headers = trace["status"], trace["level"], dict(trace["headers"])
+
+    timestamps = {key[len('x-syrin-'):]: value for key, value in headers.items() if key.startswith('x-syrin-') and key != 'x-syrin-message-id'}
+
+    durations = {}
+    for segment, starts, end in TRACE_SEGMENTS:
+        start = next((timestamps[event] for event in starts if event in timestamps), None)
+        if start is not None and end in timestamps:
+            durations[segment] = timestamps[end] - start
+
+    return {"message_id": message_id, "status": status, "level": level, "timestamps": timestamps, "durations_ms": durations}
 
-    # Close the connection
-    connection.close()
+def build_message(text, level, headers, repeat_count=None, cache_key=None):
+    """Return the routing key, JSON body, priority and trace headers for a notification."""
+    message = {"text": text, "level": level}
+    if repeat_count:
+        message["repeat_count"] = repeat_count
+    if cache_key:
+        # make-audio stores the rendered audio under this key for the next time
+        message["cache_key"] = cache_key
+    return '000_notification_' + level, json.dumps(message), get_priority(level), headers
+
+def build_play_message(text, level, filename, headers):
+    """Return the message that sends an already rendered audio straight to playback."""
+    message = {"original_text": text, "level": level, "filename": filename, "cached": True}
+    return PLAY_AUDIO_QUEUE, json.dumps(message, ensure_ascii=False), get_priority(level), headers
+
+def get_cache_key(text, level):
+    """Content hash of the normalized text and level."""
+    return hashlib.sha256(f"{level}\n{normalize_text(text)}".encode()).hexdigest()
+
+def remember_cached_audio(cache_key, object_name, expires):
+    """Remember a hit (object name) or a miss (None) until the given monotonic time."""
+    with audio_cache_lock:
+        audio_cache_index[cache_key] = (object_name, expires)
+        audio_cache_index.move_to_end(cache_key)
+        while len(audio_cache_index) > AUDIO_CACHE_INDEX_SIZE:
+            audio_cache_index.popitem(last=False)
+
+def lookup_cached_audio(cache_key):
+    """Return the MinIO object name of the cached audio, or None if it was never rendered.
+
+    Hits are remembered for AUDIO_CACHE_INDEX_TTL and misses for AUDIO_CACHE_MISS_TTL.
+    After a MinIO error the cache is skipped for AUDIO_CACHE_BACKOFF seconds.
+    """
+    global audio_cache_unavailable_until
+
+    now = time.monotonic()
+
+    with audio_cache_lock:
+        entry = audio_cache_index.get(cache_key)
+        if entry and entry[1] > now:
+            audio_cache_index.move_to_end(cache_key)
+            return entry[0]
+        if now < audio_cache_unavailable_until:
+            return None
+
+    object_name = f"{AUDIO_CACHE_PREFIX}{cache_key}.wav"
+    try:
+        minio_client.stat_object(MINIO_BUCKET_WORK, object_name)
+    except S3Error as e:
+        if e.code == 'NoSuchKey':
+            remember_cached_audio(cache_key, None, now + AUDIO_CACHE_MISS_TTL)
+            return None
+        logging.error(f"Error checking cached audio {object_name} on MinIO, skipping the cache for {AUDIO_CACHE_BACKOFF}s: {str(e)}")
+        with audio_cache_lock:
+            audio_cache_unavailable_until = now + AUDIO_CACHE_BACKOFF
+        return None
+    except Exception as e:
+        logging.error(f"Error checking cached audio {object_name} on MinIO, skipping the cache for {AUDIO_CACHE_BACKOFF}s: {str(e)}")
+        with audio_cache_lock:
+            audio_cache_unavailable_until = now + AUDIO_CACHE_BACKOFF
+        return None
+
+    remember_cached_audio(cache_key, object_name, now + AUDIO_CACHE_INDEX_TTL)
+    return object_name
+
+def build_notification_message(text, level, headers):
+    """Build the message for a new notification.
+
+    Returns (message, cached): on an audio cache hit the message goes straight to
+    playback and skips humanization and synthesis.
+    """
+    if not AUDIO_CACHE_ENABLED:
+        return build_message(text, level, headers), False
+
+    cache_key = get_cache_key(text, level)
+    filename = lookup_cached_audio(cache_key)
+    if filename:
+        logging.info(f"Audio cache hit for '{text}': {filename}")
+        AUDIO_CACHE_LOOKUPS.labels(result='hit').inc()
+        return build_play_message(text, level, filename, headers), True
+
+    AUDIO_CACHE_LOOKUPS.labels(result='miss').inc()
+    return build_message(text, level, headers, cache_key=cache_key), False
+
+def send_text_to_queue(text, level, headers):
+    """Hand the message over to the publisher.
+
+    Returns (batch, cached); batch is None when the outbox is full.
+    """
+    message, cached = build_notification_message(text, level, headers)
+    return enqueue_messages([message]), cached
+
+def normalize_text(text):
+    """Normalize an alert text so trivially different copies share the same key."""
+    return ' '.join(str(text).lower().split())
+
+def expire_duplicates(now):
+    """Drop the entries whose window is over; must be called with dedup_lock held.
+
+    Returns the merged notifications to publish as (text, level, repeat_count).
+    """
+    merged = []
+    while dedup_index:
+        key, entry = next(iter(dedup_index.items()))
+        if now - entry["first_seen"] < DEDUP_WINDOW_SECONDS and len(dedup_index) <= DEDUP_MAX_ENTRIES:
+            break
+        dedup_index.pop(key)
+        if DEDUP_MODE == 'merge' and entry["repeats"]:
+            merged.append((entry["text"], entry["level"], entry["repeats"]))
+    return merged
+
+def check_duplicate(text, level):
+    """Record a notification in the deduplication window.
+
+    Returns (duplicate, merged): whether the notification repeats one already
+    published inside the window, and the merged notifications of expired windows
+    that are now ready to publish.
+    """
+    if DEDUP_WINDOW_SECONDS <= 0:
+        return False, []
+
+    key = (normalize_text(text), level)
+    now = time.monotonic()
+
+    with dedup_lock:
+        merged = expire_duplicates(now)
+
+        entry = dedup_index.get(key)
+        if entry:
+            entry["repeats"] += 1
+            DUPLICATES_SUPPRESSED.inc()
+            return True, merged
+
+        dedup_index[key] = {"text": text, "level": level, "first_seen": now, "repeats": 0}
+        merged += expire_duplicates(now)  # enforce DEDUP_MAX_ENTRIES
+        return False, merged
+
+def forget_duplicate(text, level):
+    """Remove a notification from the window when it could not be queued after all."""
+    if DEDUP_WINDOW_SECONDS <= 0:
+        return
+
+    with dedup_lock:
+        dedup_index.pop((normalize_text(text), level), None)
+
+def flush_duplicates():
+    """Return the merged notifications of the windows that are over."""
+    with dedup_lock:
+        return expire_duplicates(time.monotonic())
+
+def build_merged_messages(merged):
+    if merged:
+        logging.info(f"Publishing {len(merged)} merged notification(s) from the deduplication window.")
+    return [build_message(text, level, start_trace(level), repeat_count) for text, level, repeat_count in merged]
+
+def enqueue_merged(merged):
+    """Hand the merged notifications to the publisher, forgetting their traces if the outbox is full."""
+    messages = build_merged_messages(merged)
+    if messages and enqueue_messages(messages) is None:
+        logging.error(f"Dropped {len(messages)} merged notification(s): outbox is full.")
+        for _, _, _, headers in messages:
+            forget_trace(headers)
+
+def dedup_flush_loop():
+    """Publish the merged notifications even when no new request arrives."""
+    while True:
+        time.sleep(1)
+        enqueue_merged(flush_duplicates())
+
+def parse_notification(data):
+    """Return (text, level, field_source) for a request payload, or None if it has no text.
+
+    The text must be a non-empty string; null, numbers or blank strings are rejected.
+    """
+    if not isinstance(data, dict):
+        return None
+
+    # Check which field the message was received from
+    if 'text' in data:
+        text, level, field_source = data['text'], "warning", 'text'
+    elif 'msg' in data:  # uptime-kuma
+        text, level, field_source = data['msg'], "error", 'msg'
+    else:
+        return None
+
+    if not isinstance(text, str) or not text.strip():
+        return None
+
+    return text, level, field_source
+
+def read_batch_items():
+    """Yield the items of a batch request, either a JSON array or an NDJSON stream.
+
+    Each item is yielded as (payload, error); NDJSON lines that are not valid JSON
+    are yielded with an error instead of aborting the whole batch.
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line), None
+            except ValueError:
+                yield None, "Invalid JSON"
+        return
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array or an NDJSON body")
+
+    for item in data:
+        yield item, None
+
+def count_status(results, status):
+    return sum(1 for result in results if result["status"] == status)
+
+def wait_requested():
+    """Whether the client asked to answer only after RabbitMQ confirmed the messages."""
+    return request.args.get('wait', '').lower() in ('true', '1', 'yes')
+
+def outbox_full_response(body):
+    """429 when the broker is just slower than the senders, 503 when it is unreachable."""
+    status = 429 if publishers_connected > 0 else 503
+    response = jsonify(body)
+    response.headers['Retry-After'] = str(API_RETRY_AFTER)
+    return response, status
+
+def wait_for_batch(batch):
+    """Block until the batch is confirmed. Returns an error message, or None on success."""
+    if not batch.done.wait(API_WAIT_TIMEOUT):
+        PUBLISH_FAILURES.labels(reason='timeout').inc()
+        return "Timed out waiting for RabbitMQ to confirm the message"
+    return batch.error
+
+def unconfirmed_response(body):
+    response = jsonify(body)
+    response.headers['Retry-After'] = str(API_RETRY_AFTER)
+    return response, 503
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    if request.url_rule is not None and request.url_rule.rule != '/metrics':
+        REQUEST_SECONDS.labels(endpoint=request.url_rule.rule, status=response.status_code).observe(time.perf_counter() - g.request_started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
 @app.route('/api/text-to-speech', methods=['POST'])
 def text_to_speech():
+    received = now_ms()
     data = request.json
 
     # Log the received request data
     app.logger.info(f"Request received with data: {data}")
 
-    if not data or ('text' not in data and 'msg' not in data):
+    notification = parse_notification(data)
+    if not notification:
         app.logger.error("No text or message provided")
         return jsonify({"error": "No text or message provided"}), 400
 
-    # Check which field the message was received from
-    if 'text' in data:
-        text = data['text']
-        field_source = 'text'
-        level = "warning"
-    elif 'msg' in data:  # uptime-kuma
-        text = data['msg']
-        field_source = 'msg'
-        level = "error"
-    else:
-        return jsonify({"error": "No text field provided"}), 400
+    text, level, field_source = notification
+    NOTIFICATIONS_RECEIVED.labels(level=level, field_source=field_source).inc()
+
+    # Publish the merged notifications whose window is over, then skip repeats
+    duplicate, merged = check_duplicate(text, level)
+    if merged:
+        enqueue_merged(merged)
+    if duplicate:
+        app.logger.info(f"Duplicate notification from field '{field_source}' suppressed.")
+        return jsonify({"message": f"Request received from field '{field_source}', duplicate of a recent notification."}), 200
 
-    # Process the text in a separate thread
-    threading.Thread(target=send_text_to_queue, args=(text, level)).start()
+    # Queue the text for the background publisher
+    headers = start_trace(level, received)
+    message_id = headers['x-syrin-message-id']
+    batch, cached = send_text_to_queue(text, level, headers)
+    if batch is None:
+        forget_duplicate(text, level)
+        forget_trace(headers)
+        return outbox_full_response({"error": "Too many pending messages, try again later"})
+
+    if wait_requested():
+        error = wait_for_batch(batch)
+        if error:
+            app.logger.error(f"Message from field '{field_source}' not confirmed: {error}")
+            return unconfirmed_response({"error": error, "message_id": message_id})
+        return jsonify({"message": f"Request received from field '{field_source}', message confirmed by RabbitMQ.", "message_id": message_id, "cached": cached}), 200
 
     # Respond immediately that the processing has been queued
-    return jsonify({"message": f"Request received from field '{field_source}', processing in progress."}), 200
+    if cached:
+        return jsonify({"message": f"Request received from field '{field_source}', cached audio queued for playback.", "message_id": message_id, "cached": True}), 200
+    return jsonify({"message": f"Request received from field '{field_source}', processing in progress.", "message_id": message_id}), 200
+
+@app.route('/api/text-to-speech/<message_id>', methods=['GET'])
+def text_to_speech_status(message_id):
+    start_publisher()
+
+    trace = get_trace(message_id)
+    if trace is None:
+        return jsonify({"error": "Unknown message id"}), 404
+    return jsonify(trace), 200
+
+@app.route('/api/text-to-speech/batch', methods=['POST'])
+def text_to_speech_batch():
+    received = now_ms()
+    results = []
+    notifications = []
+    messages = []
+    merged = []
+
+    try:
+        for index, (data, error) in enumerate(read_batch_items()):
+            notification = parse_notification(data) if error is None else None
+            if not notification:
+                results.append({"index": index, "status": "rejected", "error": error or "No text or message provided"})
+                continue
+
+            text, level, field_source = notification
+            NOTIFICATIONS_RECEIVED.labels(level=level, field_source=field_source).inc()
+            duplicate, expired = check_duplicate(text, level)
+            merged += expired
+            if duplicate:
+                results.append({"index": index, "status": "suppressed", "field_source": field_source, "level": level})
+                continue
+
+            headers = start_trace(level, received)
+            message, cached = build_notification_message(text, level, headers)
+            notifications.append((text, level))
+            messages.append(message)
+            results.append({"index": index, "status": "queued", "message_id": headers['x-syrin-message-id'], "field_source": field_source, "level": level, "cached": cached})
+    except ValueError as e:
+        app.logger.error(f"Invalid batch request: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+    app.logger.info(f"Batch request received with {len(results)} item(s), {len(messages)} valid.")
+
+    if merged:
+        enqueue_merged(merged)
+
+    if not messages:
+        return jsonify({"queued": 0, "rejected": count_status(results, "rejected"), "results": results}), 200
+
+    # A batch larger than the whole outbox would never fit, retrying it would not help
+    too_large = len(messages) > rabbitmq_outbox_size
+
+    # Publish all the valid items in one operation
+    batch = None if too_large else enqueue_messages(messages)
+    if batch is None:
+        for text, level in notifications:
+            forget_duplicate(text, level)
+        for message in messages:
+            forget_trace(message[3])
+        if too_large:
+            error = f"Batch too large: {len(messages)} valid items, at most {rabbitmq_outbox_size} are accepted per request"
+        else:
+            error = "Too many pending messages, try again later"
+        for result in results:
+            if result["status"] == "queued":
+                result.pop("message_id")
+                result.update(status="rejected", error=error)
+        body = {"queued": 0, "rejected": count_status(results, "rejected"), "results": results}
+        if too_large:
+            app.logger.error(f"Batch rejected: {error}")
+            PUBLISH_FAILURES.labels(reason='too_large').inc(len(messages))
+            return jsonify(body), 413
+        return outbox_full_response(body)
+
+    if wait_requested():
+        error = wait_for_batch(batch)
+        queued = [result for result in results if result["status"] == "queued"]
+        # The batch is committed as a whole, so `published` is either 0 or every message
+        for position, result in enumerate(queued):
+            if position < batch.published:
+                result["status"] = "confirmed"
+            else:
+                result.update(status="failed", error=error)
+        if error:
+            app.logger.error(f"Batch not fully confirmed: {error}")
+            return unconfirmed_response({"queued": len(queued), "confirmed": batch.published, "rejected": count_status(results, "rejected"), "results": results})
+
+    return jsonify({"queued": len(messages), "rejected": count_status(results, "rejected"), "results": results}), 200
 
 if __name__ == '__main__':
-    # Declare the queues before starting the Flask server
-    declare_queues()
     app.run(host='0.0.0.0', port=5121)
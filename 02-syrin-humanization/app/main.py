@@ -1,8 +1,19 @@
 import os
+import re
 import pika
 import json
 import logging
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+import functools
 import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 # Configure INFO level logging
 logging.basicConfig(level=logging.INFO)
@@ -16,16 +27,172 @@ rabbitmq_port = int(os.getenv('RABBITMQ_PORT', 5672))
 rabbitmq_vhost = os.getenv('RABBITMQ_VHOST', '')
 rabbitmq_user = os.getenv('RABBITMQ_USER', '')
 rabbitmq_pass = os.getenv('RABBITMQ_PASS', '')
-rabbitmq_ttl_dlx = int(os.getenv('RABBITMQ_TTL_DLX', 60000))  # 60 seconds TTL (60000 ms)
+# Retry tiers: the n-th retry of a message waits for the n-th delay (the last one repeats),
+# spread over RABBITMQ_RETRY_JITTER_QUEUES queues with TTLs within +/- RABBITMQ_RETRY_JITTER,
+# and the message is parked after RABBITMQ_RETRY_MAX_ATTEMPTS
+rabbitmq_retry_delays = [int(delay) for delay in os.getenv('RABBITMQ_RETRY_DELAYS', '5000,30000,120000,600000').split(',') if delay.strip()]  # ms
+rabbitmq_retry_jitter = float(os.getenv('RABBITMQ_RETRY_JITTER', 0.2))
+rabbitmq_retry_jitter_queues = int(os.getenv('RABBITMQ_RETRY_JITTER_QUEUES', 5))  # queues per delay
+rabbitmq_retry_max_attempts = int(os.getenv('RABBITMQ_RETRY_MAX_ATTEMPTS', 10))  # 0 retries for ever
+if not rabbitmq_retry_delays or min(rabbitmq_retry_delays) <= 0:
+    raise ValueError(f"RABBITMQ_RETRY_DELAYS must list at least one positive delay in ms, got '{os.getenv('RABBITMQ_RETRY_DELAYS')}'")
+if rabbitmq_retry_jitter_queues < 1:
+    raise ValueError(f"RABBITMQ_RETRY_JITTER_QUEUES must be at least 1, got {rabbitmq_retry_jitter_queues}")
+
+# Priority queues: errors overtake warnings at every stage (0 disables priorities)
+rabbitmq_max_priority = int(os.getenv('RABBITMQ_MAX_PRIORITY', 10))
+
+# Arguments of the processing queues, identical in every Syrin service
+PRIORITY_QUEUE_ARGUMENTS = {'x-max-priority': rabbitmq_max_priority} if rabbitmq_max_priority > 0 else None
 
 # Load Ollama AI settings
 OLLAMA_HOSTNAME = os.getenv('OLLAMA_HOSTNAME', '127.0.0.1:11434')
 OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama3.1')
 
+# Several Ollama nodes, comma separated; requests go to the one with the fewest in flight
+OLLAMA_HOSTNAMES = [hostname.strip() for hostname in os.getenv('OLLAMA_HOSTNAMES', OLLAMA_HOSTNAME).split(',') if hostname.strip()]
+OLLAMA_TIMEOUT = float(os.getenv('OLLAMA_TIMEOUT', 120))  # seconds
+OLLAMA_HEALTH_INTERVAL = int(os.getenv('OLLAMA_HEALTH_INTERVAL', 10))  # seconds, 0 disables the probes
+
+# Circuit breaker: after this many consecutive failures a node is skipped for the cooldown,
+# then a single trial request decides whether it is back
+OLLAMA_BREAKER_FAILURES = int(os.getenv('OLLAMA_BREAKER_FAILURES', 3))
+OLLAMA_BREAKER_COOLDOWN = int(os.getenv('OLLAMA_BREAKER_COOLDOWN', 30))  # seconds
+
+# How long Ollama keeps the model loaded after a request ("30m", "1h", seconds, or -1 for ever)
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE) if OLLAMA_KEEP_ALIVE.lstrip('-').isdigit() else OLLAMA_KEEP_ALIVE
+
+# Generation options sent with every request, as JSON, e.g. {"num_predict": 120, "num_ctx": 2048}
+OLLAMA_OPTIONS = json.loads(os.getenv('OLLAMA_OPTIONS', '') or 'null')
+
+# Load the model before consuming, and reload it when no request was sent for this many seconds (0 disables)
+OLLAMA_WARMUP = os.getenv('OLLAMA_WARMUP', 'true').lower() == 'true'
+OLLAMA_KEEP_WARM_INTERVAL = int(os.getenv('OLLAMA_KEEP_WARM_INTERVAL', 600))
+
 # Load Ollama AI prompts
 PROMPT_ERROR = os.getenv('PROMPT_ERROR', 'I will give you a text where I want you to inform me in a professional and direct manner what happened. Your information should request a technical team to get involved to solve the issue briefly, and your response should never exceed 200 characters. Here is the text:')
 PROMPT_GENERIC = os.getenv('PROMPT_GENERIC', 'I will give you a text, where I want you to use humor. The text will be in Brazilian Portuguese, and your response must be exactly and only one sentence in Portuguese. Your response should be in an informative or directive tone so I can take action based on the content of the following text:')
 
+# Micro-batching: alerts arriving within the window are summarized by a single Ollama request
+# (a batch size of 1 disables it)
+HUMANIZATION_BATCH_SIZE = int(os.getenv('HUMANIZATION_BATCH_SIZE', 1))
+HUMANIZATION_BATCH_WINDOW = float(os.getenv('HUMANIZATION_BATCH_WINDOW', 2))  # seconds
+PROMPT_SUMMARY = os.getenv('PROMPT_SUMMARY', 'I will give you a list of alerts that happened within a few seconds of each other. Summarize them in a professional and direct manner, saying how many alerts there were and what they have in common. Your response should never exceed 300 characters. Here are the alerts:')
+
+# Streaming mode: publish each sentence to make-audio as soon as Ollama has generated it
+OLLAMA_STREAM = os.getenv('OLLAMA_STREAM', 'false').lower() == 'true'
+OLLAMA_STREAM_MIN_CHARS = int(os.getenv('OLLAMA_STREAM_MIN_CHARS', 20))  # shorter sentences are merged with the next one
+
+# End of a sentence, confirmed once the next sentence has started
+SENTENCE_END = re.compile(r'(?:[.!?…]+["\'”)\]]*\s+|\n+)(?=\S)')
+
+# Number of messages humanized at the same time, also used as the prefetch count.
+# Match it with OLLAMA_NUM_PARALLEL on the Ollama side (1 keeps the sequential behavior)
+HUMANIZATION_CONCURRENCY = int(os.getenv('HUMANIZATION_CONCURRENCY', 1))
+if OLLAMA_STREAM and HUMANIZATION_CONCURRENCY > 1:
+    # Concurrent streams would interleave the sentences of different alerts in 001
+    logging.error("OLLAMA_STREAM requires HUMANIZATION_CONCURRENCY=1, humanizing one message at a time.")
+    HUMANIZATION_CONCURRENCY = 1
+
+# JSON file with the template rules applied before Ollama (empty disables them)
+HUMANIZATION_RULES_PATH = os.getenv('HUMANIZATION_RULES_PATH', '')
+
+# Load humanization cache settings: in-memory LRU in front of a SQLite file that survives restarts
+HUMANIZATION_CACHE_ENABLED = os.getenv('HUMANIZATION_CACHE_ENABLED', 'true').lower() == 'true'
+HUMANIZATION_CACHE_TTL = int(os.getenv('HUMANIZATION_CACHE_TTL', 86400))  # seconds
+HUMANIZATION_CACHE_MEMORY_SIZE = int(os.getenv('HUMANIZATION_CACHE_MEMORY_SIZE', 1000))  # entries
+HUMANIZATION_CACHE_DISK_SIZE = int(os.getenv('HUMANIZATION_CACHE_DISK_SIZE', 100000))  # entries
+HUMANIZATION_CACHE_PATH = os.getenv('HUMANIZATION_CACHE_PATH', '/app/cache/humanization.sqlite3')  # empty: memory only
+
+# Near-duplicate alerts: volatile tokens are masked before the cache lookup and the cached
+# answer is a template whose slots are filled from the new alert
+HUMANIZATION_NORMALIZE = os.getenv('HUMANIZATION_NORMALIZE', 'true').lower() == 'true'
+HUMANIZATION_PATTERN_METRICS_SIZE = int(os.getenv('HUMANIZATION_PATTERN_METRICS_SIZE', 200))  # patterns with their own hit rate series
+
+# Volatile tokens by slot name, tried in this order at every position
+VOLATILE_TOKENS = [
+    ('timestamp', r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?(?!\d)|\d{1,2}/\d{1,2}/\d{2,4}(?: \d{1,2}:\d{2}(?::\d{2})?)?(?!\d)|\d{1,2}:\d{2}:\d{2}(?!\d)'),
+    ('uuid', r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?![\w-])'),
+    ('ip', r'\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?(?!\w|\.\d)'),
+    ('hex', r'(?=[0-9a-fA-F]*\d)(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{8,}(?!\w)'),  # hashes, container and commit ids
+    ('percent', r'\d+(?:[.,]\d+)?%'),
+    # Three-digit 1xx-5xx numbers stay in the pattern: HTTP status codes change what the alert means
+    ('number', r'(?![1-5]\d{2}(?![\d.,]))\d+(?:[.,]\d+)?(?!\d)'),
+]
+VOLATILE_TOKEN = re.compile(r'(?<![\w.])(?:' + '|'.join(f"(?P<{name}>{pattern})" for name, pattern in VOLATILE_TOKENS) + ')')
+
+# Port of the Prometheus metrics endpoint (0 disables it)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9102))
+
+# Humanized texts by cache key, least recently used first: key -> (text, expiry)
+humanization_cache = OrderedDict()
+humanization_cache_lock = threading.Lock()
+humanization_cache_db = None
+
+# Patterns with a hit rate series, least recently seen first (bounds the metric cardinality)
+pattern_lookups = OrderedDict()
+
+# Worker threads calling Ollama in concurrent mode
+humanization_pool = ThreadPoolExecutor(max_workers=HUMANIZATION_CONCURRENCY, thread_name_prefix='humanize') if HUMANIZATION_CONCURRENCY > 1 else None
+
+# Pooled keep-alive HTTP connections to every Ollama node, one per worker plus the background threads
+ollama_session = requests.Session()
+ollama_session.mount('http://', HTTPAdapter(pool_connections=len(OLLAMA_HOSTNAMES), pool_maxsize=HUMANIZATION_CONCURRENCY + 2))
+
+# Monotonic time of the last request sent to Ollama
+ollama_last_request = 0.0
+
+# Prometheus metrics of the humanization agent
+HUMANIZATION_CACHE_LOOKUPS = Counter('syrin_humanization_cache_lookups_total', 'Humanization cache lookups', ['result'])
+HUMANIZATION_PATTERN_LOOKUPS = Counter('syrin_humanization_pattern_lookups_total', 'Humanization cache lookups by normalized alert pattern', ['pattern', 'result'])
+OLLAMA_REQUEST_SECONDS = Histogram('syrin_humanization_ollama_request_seconds', 'Time spent in Ollama generate requests', ['backend', 'result'], buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120))
+OLLAMA_BACKEND_OUTSTANDING = Gauge('syrin_humanization_ollama_outstanding_requests', 'Requests in flight per Ollama node', ['backend'])
+OLLAMA_BACKEND_UP = Gauge('syrin_humanization_ollama_backend_up', 'Whether the Ollama node is healthy and its circuit breaker closed', ['backend'])
+HUMANIZATION_RULE_MATCHES = Counter('syrin_humanization_rule_matches_total', 'Messages humanized by a template rule, or unmatched', ['rule'])
+
+class OllamaBackend:
+    """An Ollama node with its health, circuit breaker and requests in flight."""
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.outstanding = 0
+        self.failures = 0  # consecutive failed requests
+        self.open_until = 0.0  # the breaker is open until this monotonic time
+        self.trial = False  # a half-open trial request is in flight
+        self.healthy = True  # result of the last health probe
+
+    def is_open(self):
+        return self.failures >= OLLAMA_BREAKER_FAILURES
+
+    def available(self, now):
+        if not self.healthy:
+            return False
+        if not self.is_open():
+            return True
+        # Half-open: let a single request through once the cooldown is over
+        return now >= self.open_until and not self.trial
+
+ollama_backends = [OllamaBackend(hostname) for hostname in OLLAMA_HOSTNAMES]
+ollama_backends_lock = threading.Lock()
+
+for ollama_backend in ollama_backends:
+    OLLAMA_BACKEND_OUTSTANDING.labels(backend=ollama_backend.hostname).set_function(lambda backend=ollama_backend: backend.outstanding)
+    OLLAMA_BACKEND_UP.labels(backend=ollama_backend.hostname).set_function(lambda backend=ollama_backend: 1 if backend.healthy and not backend.is_open() else 0)
+
+# Messages waiting for the batch window to close: (delivery_tag, header_frame, message, started),
+# only used by the connection thread
+humanization_batch = []
+humanization_batch_timer = None
+
+# Warnings wait while errors are pending: consumer tag of the warning queue (None while paused)
+# and delivery tags of the error messages not acknowledged yet, only used by the connection thread
+warning_consumer_tag = None
+errors_in_flight = set()
+
+# Compiled template rules: list of {"name", "level", "pattern", "templates"}
+humanization_rules = []
+
 def connect_to_rabbitmq():
     try:
         # Set the credentials and connection parameters
@@ -49,120 +216,858 @@ def connect_to_rabbitmq():
         logging.error(f"Error connecting to RabbitMQ: {str(e)}")
         return None
 
-def delete_queue_if_exists(channel, queue_name):
-    try:
-        # Attempt to delete the existing queue
-        channel.queue_delete(queue=queue_name)
-        logging.info(f"Queue '{queue_name}' deleted successfully.")
-    except pika.exceptions.ChannelClosedByBroker as e:
-        if e.reply_code == 404:
-            logging.info(f"Queue '{queue_name}' does not exist. No action needed.")
-        else:
-            logging.error(f"Error deleting queue '{queue_name}': {str(e)}")
-            raise
+def get_priority(level):
+    """Map the message level to an AMQP priority."""
+    if rabbitmq_max_priority <= 0:
+        return None
+    return rabbitmq_max_priority if level == 'error' else 1
+
+def now_ms():
+    """Epoch timestamp in milliseconds, as used in the x-syrin-* trace headers."""
+    return int(time.time() * 1000)
 
-def requestOllama(text, level):
-    url = f"http://{OLLAMA_HOSTNAME}/api/generate"
+def trace_headers(header_frame, **timestamps):
+    """Copy the correlation headers of the incoming message and add this stage's timestamps."""
+    headers = dict(header_frame.headers or {}) if header_frame is not None else {}
+    for event, value in timestamps.items():
+        headers[f"x-syrin-humanization-{event}"] = value
+    return headers
 
+def build_prompt(text, level):
     if level == "error":
-        prompt = f"{PROMPT_ERROR} {text}"
-    else:
-        prompt = f"{PROMPT_GENERIC} {text}"
+        return f"{PROMPT_ERROR} {text}"
+    return f"{PROMPT_GENERIC} {text}"
+
+def build_payload(prompt, stream=False):
+    """Body of an Ollama /api/generate request; without a prompt Ollama only loads the model."""
+    global ollama_last_request
+    ollama_last_request = time.monotonic()
 
     payload = {
         "model": OLLAMA_MODEL,
-        "stream": False,
-        "prompt": prompt
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE
     }
+    if prompt:
+        payload["prompt"] = prompt
+    if OLLAMA_OPTIONS:
+        payload["options"] = OLLAMA_OPTIONS
+    return payload
+
+def acquire_backend():
+    """Pick the available Ollama node with the fewest requests in flight, or None."""
+    now = time.monotonic()
+
+    with ollama_backends_lock:
+        candidates = [backend for backend in ollama_backends if backend.available(now)]
+        if not candidates:
+            return None
+
+        fewest = min(backend.outstanding for backend in candidates)
+        backend = random.choice([backend for backend in candidates if backend.outstanding == fewest])
+        if backend.is_open():
+            backend.trial = True
+        backend.outstanding += 1
+        return backend
+
+def release_backend(backend, ok, started):
+    """Record the outcome of a request and open or close the node's circuit breaker."""
+    OLLAMA_REQUEST_SECONDS.labels(backend=backend.hostname, result='ok' if ok else 'error').observe(time.monotonic() - started)
+
+    with ollama_backends_lock:
+        backend.outstanding -= 1
+        backend.trial = False
+        if ok:
+            if backend.is_open():
+                logging.info(f"Ollama node {backend.hostname} answered again, circuit breaker closed.")
+            backend.failures = 0
+            return
+
+        backend.failures += 1
+        if backend.is_open():
+            backend.open_until = time.monotonic() + OLLAMA_BREAKER_COOLDOWN
+            logging.error(f"Ollama node {backend.hostname} failed {backend.failures} times in a row, circuit breaker open for {OLLAMA_BREAKER_COOLDOWN} s.")
+
+def health_check_loop():
+    """Probe every Ollama node so requests are only sent to the ones that answer."""
+    while True:
+        for backend in ollama_backends:
+            try:
+                ollama_session.get(f"http://{backend.hostname}/api/version", timeout=5).raise_for_status()
+                healthy = True
+            except requests.RequestException as e:
+                healthy = False
+                if backend.healthy:
+                    logging.error(f"Ollama node {backend.hostname} failed its health check: {str(e)}")
+            if healthy and not backend.healthy:
+                logging.info(f"Ollama node {backend.hostname} is healthy again.")
+            backend.healthy = healthy
+        time.sleep(OLLAMA_HEALTH_INTERVAL)
+
+def warm_up_ollama():
+    """Load the model into memory on every node so the first alert does not pay the cold start."""
+    loaded = False
+    for backend in ollama_backends:
+        started = time.monotonic()
+        try:
+            response = ollama_session.post(f"http://{backend.hostname}/api/generate", json=build_payload(None), timeout=300)
+            response.raise_for_status()
+            logging.info(f"Ollama model {OLLAMA_MODEL} loaded on {backend.hostname} in {time.monotonic() - started:.1f} s.")
+            loaded = True
+        except requests.RequestException as e:
+            logging.error(f"Error loading the Ollama model {OLLAMA_MODEL} on {backend.hostname}: {str(e)}")
+    return loaded
+
+def keep_warm_loop():
+    """Reload the model during quiet hours, before Ollama unloads it."""
+    while True:
+        idle = time.monotonic() - ollama_last_request
+        if idle < OLLAMA_KEEP_WARM_INTERVAL:
+            time.sleep(OLLAMA_KEEP_WARM_INTERVAL - idle)
+            continue
+        warm_up_ollama()
+
+def build_summary_prompt(messages):
+    lines = []
+    for message in messages:
+        repeats = f" (repeated {message['repeat_count']} more times)" if message.get('repeat_count') else ""
+        lines.append(f"- [{message['level']}] {message['text']}{repeats}")
+    return PROMPT_SUMMARY + "\n" + "\n".join(lines)
+
+def requestOllama(text, level, prompt=None):
+    backend = acquire_backend()
+    if backend is None:
+        logging.error("No Ollama node available, failing fast.")
+        return ""
+
+    url = f"http://{backend.hostname}/api/generate"
+
+    prompt = prompt or build_prompt(text, level)
+
+    payload = build_payload(prompt)
 
+    started = time.monotonic()
     try:
-        response = requests.post(url, json=payload, timeout=120)
+        response = ollama_session.post(url, json=payload, timeout=OLLAMA_TIMEOUT)
         response.raise_for_status()
         response_data = response.json()
 
+        release_backend(backend, True, started)
         return response_data.get("response")
-    except requests.RequestException as e:
-        logging.error(f"Error in request to Ollama: {str(e)}")
+    except (requests.RequestException, ValueError) as e:
+        logging.error(f"Error in request to Ollama node {backend.hostname}: {str(e)}")
+        release_backend(backend, False, started)
         return ""
 
-def declare_reprocess_queue(channel):
+def open_humanization_cache():
+    """Open (or create) the on-disk tier of the humanization cache."""
+    global humanization_cache_db
+
+    if not HUMANIZATION_CACHE_ENABLED or not HUMANIZATION_CACHE_PATH:
+        return
+
     try:
-        # Delete the queue if it already exists to avoid parameter conflicts
-        delete_queue_if_exists(channel, '001_notification_reprocess_humanized')
-        
-        # Declare the queue with TTL and DLX
-        channel.queue_declare(
-            queue='001_notification_reprocess_humanized',
-            durable=True,
-            arguments={
-                'x-message-ttl': rabbitmq_ttl_dlx,  # 60 seconds TTL (60000 ms)
-                'x-dead-letter-exchange': '',  # Default DLX for routing to another queue
-                'x-dead-letter-routing-key': '001_notification_process_humanized'  # Queue to move the message to
+        os.makedirs(os.path.dirname(HUMANIZATION_CACHE_PATH) or '.', exist_ok=True)
+        db = sqlite3.connect(HUMANIZATION_CACHE_PATH, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS humanized (key TEXT PRIMARY KEY, text TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS humanized_used ON humanized (used)")
+        db.execute("DELETE FROM humanized WHERE expires < ?", (time.time(),))
+        db.commit()
+        humanization_cache_db = db
+        count = db.execute("SELECT COUNT(*) FROM humanized").fetchone()[0]
+        logging.info(f"Humanization cache opened at {HUMANIZATION_CACHE_PATH} with {count} entries.")
+    except sqlite3.Error as e:
+        logging.error(f"Error opening the humanization cache at {HUMANIZATION_CACHE_PATH}, using memory only: {str(e)}")
+    except OSError as e:
+        logging.error(f"Error creating the humanization cache directory, using memory only: {str(e)}")
+
+def load_humanization_rules():
+    """Compile the template rules of HUMANIZATION_RULES_PATH; invalid rules are skipped."""
+    global humanization_rules
+
+    if not HUMANIZATION_RULES_PATH:
+        return
+
+    try:
+        with open(HUMANIZATION_RULES_PATH, encoding='utf-8') as rules_file:
+            definitions = json.load(rules_file)
+    except (OSError, ValueError) as e:
+        logging.error(f"Error loading the humanization rules from {HUMANIZATION_RULES_PATH}: {str(e)}")
+        return
+
+    rules = []
+    for position, definition in enumerate(definitions):
+        name = definition.get('name', f"rule-{position}")
+        try:
+            templates = definition['template']
+            rules.append({
+                "name": name,
+                "level": definition.get('level'),
+                "pattern": re.compile(definition['pattern']),
+                "templates": [templates] if isinstance(templates, str) else list(templates)
+            })
+        except (KeyError, TypeError, re.error) as e:
+            logging.error(f"Invalid humanization rule '{name}': {str(e)}")
+
+    humanization_rules = rules
+    logging.info(f"Loaded {len(rules)} humanization rule(s) from {HUMANIZATION_RULES_PATH}.")
+
+def apply_humanization_rules(text, level, repeat_count=0):
+    """Return the text of the first matching template rule, or None to ask Ollama."""
+    if not humanization_rules:
+        return None
+
+    for rule in humanization_rules:
+        if rule["level"] and rule["level"] != level:
+            continue
+        match = rule["pattern"].search(text)
+        if not match:
+            continue
+        try:
+            # Templates use the named groups plus text, level and repeat_count
+            fields = {"text": text, "level": level, "repeat_count": repeat_count}
+            fields.update({key: value or '' for key, value in match.groupdict().items()})
+            humanized = random.choice(rule["templates"]).format_map(fields)
+        except (KeyError, IndexError, ValueError) as e:
+            logging.error(f"Error applying humanization rule '{rule['name']}': {str(e)}")
+            continue
+        HUMANIZATION_RULE_MATCHES.labels(rule=rule["name"]).inc()
+        return humanized
+
+    HUMANIZATION_RULE_MATCHES.labels(rule='unmatched').inc()
+    logging.info(f"No humanization rule matched: {text}")
+    return None
+
+def get_cache_key(text, level):
+    """Hash of everything that shapes the answer: model, resolved prompt and text."""
+    return hashlib.sha256(f"{OLLAMA_MODEL}\n{build_prompt(text, level)}".encode()).hexdigest()
+
+def normalize_alert(text):
+    """Mask the volatile tokens of an alert. Returns (pattern, values).
+
+    "Disk at 91% on 10.0.0.7" gives ("Disk at <percent> on <ip>", ["91%", "10.0.0.7"]).
+    """
+    values = []
+
+    def mask(match):
+        values.append(match.group(0))
+        return f"<{match.lastgroup}>"
+
+    return VOLATILE_TOKEN.sub(mask, text), values
+
+def build_template(text_humanized, values):
+    """Turn an answer into a template whose slots ({0}, {1}...) are the alert's volatile values.
+
+    Returns None when the answer still holds a volatile token that is not one of them, e.g. a
+    value the model reformatted, as it could not be filled in for another alert, or when it
+    leaves out one of the alert's values, as it would then be served for alerts with other facts.
+    """
+    template = text_humanized.replace('{', '{{').replace('}', '}}')
+
+    slots = {}
+    for index, value in enumerate(values):
+        slots.setdefault(value, index)
+    if slots:
+        # Longest values first, so 10.0.0.1 is not replaced as 10.0 and 0.1
+        alternation = '|'.join(re.escape(value) for value in sorted(slots, key=len, reverse=True))
+        template = re.sub(rf'(?<![\w.])(?:{alternation})(?![\w%]|\.\d)', lambda match: f"{{{slots[match.group(0)]}}}", template)
+
+    if VOLATILE_TOKEN.search(re.sub(r'\{\d+\}', ' ', template)):
+        return None
+    if any(f"{{{index}}}" not in template for index in set(slots.values())):
+        return None
+    return template
+
+def record_pattern_lookup(pattern, result):
+    """Count a cache lookup for the pattern, keeping series for the most recent patterns only."""
+    pattern = pattern[:120]
+
+    with humanization_cache_lock:
+        pattern_lookups[pattern] = True
+        pattern_lookups.move_to_end(pattern)
+        while len(pattern_lookups) > HUMANIZATION_PATTERN_METRICS_SIZE:
+            evicted, _ = pattern_lookups.popitem(last=False)
+            for evicted_result in ('hit', 'miss'):
+                try:
+                    HUMANIZATION_PATTERN_LOOKUPS.remove(evicted, evicted_result)
+                except KeyError:
+                    pass
+
+    HUMANIZATION_PATTERN_LOOKUPS.labels(pattern=pattern, result=result).inc()
+
+def remember_humanized(key, text, expires):
+    """Put an entry in the in-memory tier; must be called with humanization_cache_lock held."""
+    humanization_cache[key] = (text, expires)
+    humanization_cache.move_to_end(key)
+    while len(humanization_cache) > HUMANIZATION_CACHE_MEMORY_SIZE:
+        humanization_cache.popitem(last=False)
+
+def get_cached_humanization(keys):
+    """Return the cached template of the first key found, or None."""
+    now = time.time()
+
+    with humanization_cache_lock:
+        for key in keys:
+            entry = humanization_cache.get(key)
+            if entry and entry[1] > now:
+                humanization_cache.move_to_end(key)
+                HUMANIZATION_CACHE_LOOKUPS.labels(result='memory_hit').inc()
+                return entry[0]
+            humanization_cache.pop(key, None)
+
+        if humanization_cache_db is not None:
+            try:
+                for key in keys:
+                    row = humanization_cache_db.execute("SELECT text, expires FROM humanized WHERE key = ? AND expires > ?", (key, now)).fetchone()
+                    if row:
+                        humanization_cache_db.execute("UPDATE humanized SET used = ? WHERE key = ?", (now, key))
+                        humanization_cache_db.commit()
+                        remember_humanized(key, row[0], row[1])
+                        HUMANIZATION_CACHE_LOOKUPS.labels(result='disk_hit').inc()
+                        return row[0]
+            except sqlite3.Error as e:
+                logging.error(f"Error reading the humanization cache: {str(e)}")
+
+    HUMANIZATION_CACHE_LOOKUPS.labels(result='miss').inc()
+    return None
+
+def store_humanization(key, text):
+    now = time.time()
+    expires = now + HUMANIZATION_CACHE_TTL
+
+    with humanization_cache_lock:
+        remember_humanized(key, text, expires)
+
+        if humanization_cache_db is not None:
+            try:
+                humanization_cache_db.execute("INSERT OR REPLACE INTO humanized (key, text, expires, used) VALUES (?, ?, ?, ?)", (key, text, expires, now))
+                # Drop the expired entries, then the least recently used ones above the size limit
+                humanization_cache_db.execute("DELETE FROM humanized WHERE expires < ?", (now,))
+                humanization_cache_db.execute(
+                    "DELETE FROM humanized WHERE key IN (SELECT key FROM humanized ORDER BY used LIMIT max((SELECT COUNT(*) FROM humanized) - ?, 0))",
+                    (HUMANIZATION_CACHE_DISK_SIZE,)
+                )
+                humanization_cache_db.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Error writing the humanization cache: {str(e)}")
+
+def split_sentences(buffer):
+    """Split the finished sentences off the generated text. Returns (sentences, rest)."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(buffer):
+        if match.end() - start >= OLLAMA_STREAM_MIN_CHARS:
+            sentences.append(buffer[start:match.end()].strip())
+            start = match.end()
+    return sentences, buffer[start:]
+
+def streamOllama(text, level, publish_chunk):
+    """Stream the generation and call publish_chunk(sentence, index, last) for each sentence.
+
+    Returns the whole generated text, or "" when the stream failed. A stream that breaks
+    mid-way is failed as a whole: its partial text is neither cached nor published as the
+    last chunk, and the message is retried (the sentences already published replay).
+    """
+    backend = acquire_backend()
+    if backend is None:
+        logging.error("No Ollama node available, failing fast.")
+        return ""
+
+    url = f"http://{backend.hostname}/api/generate"
+
+    payload = build_payload(build_prompt(text, level), stream=True)
+
+    generated = ""
+    buffer = ""
+    index = 0
+    started = time.monotonic()
+    ok = False
+    try:
+        with ollama_session.post(url, json=payload, stream=True, timeout=OLLAMA_TIMEOUT) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                generated += data.get("response", "")
+                buffer += data.get("response", "")
+
+                sentences, buffer = split_sentences(buffer)
+                for sentence in sentences:
+                    publish_chunk(sentence, index, False)
+                    index += 1
+
+                if data.get("done"):
+                    break
+        ok = True
+    except (requests.RequestException, ValueError) as e:
+        logging.error(f"Error in streaming request to Ollama node {backend.hostname} after {index} sentence(s): {str(e)}")
+        return ""
+    finally:
+        release_backend(backend, ok, started)
+
+    # The last sentence has no following sentence to confirm its end
+    if buffer.strip():
+        publish_chunk(buffer.strip(), index, True)
+    elif index == 0:
+        return ""
+
+    return generated.strip()
+
+def fill_template(template, values):
+    """Fill the slots of a cached template, or None if it does not fit the values."""
+    try:
+        return template.format(*values)
+    except (IndexError, KeyError, ValueError) as e:
+        logging.error(f"Error filling the cached humanization template: {str(e)}")
+        return None
+
+def humanize(text, level, publish_chunk=None):
+    """Humanize the text, answering repeated alerts from the cache instead of Ollama.
+
+    Near-duplicates (same alert with other timestamps, ids, numbers...) share the cached
+    template of their pattern. Answers that do not fit a template are cached for the exact
+    text only. With publish_chunk, the text is streamed sentence by sentence (see streamOllama).
+    """
+    if not HUMANIZATION_CACHE_ENABLED:
+        if publish_chunk:
+            return streamOllama(text, level, publish_chunk)
+        return requestOllama(text, level)
+
+    pattern, values = normalize_alert(text) if HUMANIZATION_NORMALIZE else (text, [])
+    pattern_key = get_cache_key(pattern, level)
+    exact_key = get_cache_key(text, level)
+    keys = [pattern_key] if pattern_key == exact_key else [pattern_key, exact_key]
+
+    template = get_cached_humanization(keys)
+    cached = fill_template(template, values) if template else None
+    if HUMANIZATION_NORMALIZE:
+        record_pattern_lookup(pattern, 'hit' if cached else 'miss')
+    if cached:
+        logging.info(f"Humanization cache hit for: {text}")
+        if publish_chunk:
+            publish_chunk(cached, 0, True)
+        return cached
+
+    if publish_chunk:
+        text_humanized = streamOllama(text, level, publish_chunk)
+    else:
+        text_humanized = requestOllama(text, level)
+    if text_humanized:
+        template = build_template(text_humanized, values)
+        if template is not None:
+            store_humanization(pattern_key, template)
+        else:
+            store_humanization(exact_key, text_humanized.replace('{', '{{').replace('}', '}}'))
+    return text_humanized
+
+def get_delay_label(delay):
+    """Readable suffix of a retry queue: 5s, 30s, 2m, 1500ms..."""
+    if delay % 60000 == 0:
+        return f"{delay // 60000}m"
+    if delay % 1000 == 0:
+        return f"{delay // 1000}s"
+    return f"{delay}ms"
+
+# Queues declared at startup with their arguments; publishers never declare on the hot path
+declared_queues = {}
+
+def get_retry_tier(retry_prefix, delay):
+    """Queues of one retry delay with their TTL, spread evenly over delay +/- RABBITMQ_RETRY_JITTER.
+
+    RabbitMQ only expires messages at the head of a queue, so a per-message expiration would wait
+    for the longest one queued ahead. Every message of these queues has the queue's TTL instead.
+    """
+    if rabbitmq_retry_jitter_queues == 1 or not rabbitmq_retry_jitter:
+        spreads = [0.0]
+    else:
+        spreads = [rabbitmq_retry_jitter * (2 * index / (rabbitmq_retry_jitter_queues - 1) - 1) for index in range(rabbitmq_retry_jitter_queues)]
+    return [(f"{retry_prefix}_{get_delay_label(delay)}_{index + 1}", max(int(delay * (1 + spread)), 1)) for index, spread in enumerate(spreads)]
+
+def get_retry_queues(retry_prefix, destination, parking_queue):
+    """Retry tier queues of a stage, dead-lettering to the destination, plus its parking queue."""
+    queues = {parking_queue: None}
+    for delay in rabbitmq_retry_delays:
+        for queue, ttl in get_retry_tier(retry_prefix, delay):
+            queues[queue] = {
+                'x-message-ttl': ttl,
+                'x-dead-letter-exchange': '',  # Default exchange
+                'x-dead-letter-routing-key': destination  # Queue where expired messages are moved
             }
+    return queues
+
+def declare_topology(channel, queues):
+    """Declare every queue once and remember it for the publishers.
+
+    Declaring an existing queue with other arguments makes RabbitMQ close the channel
+    (PRECONDITION_FAILED), so a topology that does not match stops the service at startup
+    instead of losing messages later.
+    """
+    for queue, arguments in queues.items():
+        try:
+            channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            logging.error(f"Queue '{queue}' exists with arguments other than {arguments}: {str(e)}")
+            raise
+        declared_queues[queue] = arguments
+        logging.info(f"Queue '{queue}' checked or created.")
+
+def ensure_declared(queue):
+    """Fail before publishing to a queue missing from the topology, which would drop the message."""
+    if queue not in declared_queues:
+        raise KeyError(f"Queue '{queue}' is not part of the declared topology")
+
+def schedule_retry(channel, message, headers, retry_prefix, destination, parking_queue, stage):
+    """Send a failed message to the retry tier of its attempt, or park it after the last attempt.
+
+    Each tier is a set of queues without consumers, declared at startup by get_retry_queues, that
+    dead-letter expired messages back to the destination queue. Picking one of them at random
+    adds the jitter, so retries do not come back in synchronized waves. Returns the queue the
+    message was published to, and raises when it could not be published.
+    """
+    headers = dict(headers or {})
+    attempt = int(headers.get(f"x-syrin-{stage}-retries", 0)) + 1
+    headers[f"x-syrin-{stage}-retries"] = attempt
+
+    if rabbitmq_retry_max_attempts and attempt > rabbitmq_retry_max_attempts:
+        queue = parking_queue
+        properties = pika.BasicProperties(delivery_mode=2, priority=get_priority(message.get('level')), headers=headers)
+        logging.error(f"Message still failing after {attempt - 1} retries, parked in '{queue}'.")
+    else:
+        delay = rabbitmq_retry_delays[min(attempt, len(rabbitmq_retry_delays)) - 1]
+        queue, ttl = random.choice(get_retry_tier(retry_prefix, delay))
+        properties = pika.BasicProperties(
+            delivery_mode=2,  # Persist the message
+            priority=get_priority(message.get('level')),  # Kept when the message is dead-lettered
+            headers=headers
         )
-        logging.info(f"Queue '001_notification_reprocess_humanized' checked or created with TTL of {rabbitmq_ttl_dlx} ms.")
-    except Exception as e:
-        logging.error(f"Error declaring the reprocessing queue: {str(e)}")
+        logging.info(f"Retry {attempt} scheduled in {ttl} ms through '{queue}'.")
 
-def reprocess_message(channel, message):
+    ensure_declared(queue)
+    channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(message, ensure_ascii=False), properties=properties)
+    return queue
+
+def reprocess_message(channel, message, headers=None):
+    """Send the message to its retry tier. Returns False if it could not be published."""
     try:
-        # Ensure the queue was declared correctly with TTL and DLX arguments
-        declare_reprocess_queue(channel)
-        
-        # Publish the message to the queue
-        channel.basic_publish(
-            exchange='',
-            routing_key='001_notification_reprocess_humanized',
-            body=json.dumps(message, ensure_ascii=False),  # Allow special characters in JSON
-            properties=pika.BasicProperties(delivery_mode=2)  # Persist the message
+        # Retried messages go back to the queue of their level
+        schedule_retry(
+            channel, message, headers,
+            retry_prefix=f"001_notification_reprocess_humanized_{message['level']}",
+            destination=f"000_notification_{message['level']}",
+            parking_queue='001_notification_parked_humanized',
+            stage='humanization'
         )
         
-        logging.info(f"Message sent to the reprocessing queue: {message['text']}")
+        logging.info(f"Message sent to the reprocessing queue: {message.get('text')}")
+        return True
     except Exception as e:
         logging.error(f"Error reprocessing the message: {str(e)}")
+        return False
 
-def send_to_humanized_queue(channel, text_humanized, original_message):
+def park_message(channel, message, headers=None):
+    """Send a message that no retry can fix straight to the parking queue. Returns False if it could not be published."""
     try:
-        # Ensure the '001_notification_process_humanized' queue exists
-        channel.queue_declare(queue='001_notification_process_humanized', durable=True)
+        ensure_declared('001_notification_parked_humanized')
+        channel.basic_publish(
+            exchange='',
+            routing_key='001_notification_parked_humanized',
+            body=json.dumps(message, ensure_ascii=False),
+            properties=pika.BasicProperties(delivery_mode=2, priority=get_priority(message.get('level')), headers=headers)
+        )
+
+        logging.error(f"Message parked in '001_notification_parked_humanized': {message}")
+        return True
+    except Exception as e:
+        logging.error(f"Error parking the message: {str(e)}")
+        return False
 
+def send_to_humanized_queue(channel, text_humanized, original_message, headers=None, chunk=None):
+    """Publish the humanized text to make-audio. Returns False if it could not be published."""
+    try:
         # Send the humanized text to the queue
         message = {
             'original_text': original_message['text'],
             'level': original_message['level'],
             'humanized_text': text_humanized
         }
-        
+
+        # Streamed sentences are numbered so the next stages can keep them in order
+        if chunk is not None:
+            message['chunk_index'], message['chunk_last'] = chunk
+
+        # Let make-audio store the rendered audio in the REST API audio cache (whole texts only)
+        if original_message.get('cache_key') and chunk in (None, (0, True)):
+            message['cache_key'] = original_message['cache_key']
+
+        # Summaries of a batch reference the alerts they replace
+        if original_message.get('originals'):
+            message['originals'] = original_message['originals']
+
+        if headers is not None:
+            headers['x-syrin-humanization-enqueued'] = now_ms()
+
         channel.basic_publish(
             exchange='',
             routing_key='001_notification_process_humanized',
             body=json.dumps(message, ensure_ascii=False),  # Allow special characters in JSON
-            properties=pika.BasicProperties(delivery_mode=2)  # Persist the message
+            properties=pika.BasicProperties(delivery_mode=2, priority=get_priority(message['level']), headers=headers)  # Persist the message
         )
         
         logging.info(f"Humanized message sent to '001_notification_process_humanized' queue: {message}")
+        return True
     except Exception as e:
         logging.error(f"Error sending message to the humanized queue: {str(e)}")
+        return False
+
+def humanize_message(message, publish_chunk=None):
+    # Known alert shapes are humanized from a template, without the LLM
+    text_humanized = apply_humanization_rules(message['text'], message['level'], message.get('repeat_count', 0))
+    if text_humanized:
+        logging.info(f"Humanized by template rule: {text_humanized}")
+        if publish_chunk:
+            publish_chunk(text_humanized, 0, True)
+        return text_humanized
+
+    # Alerts merged by the REST API deduplication window carry how often they repeated
+    text = message['text']
+    if message.get('repeat_count'):
+        text = f"{text} (this alert repeated {message['repeat_count']} more times)"
+
+    return humanize(text, message['level'], publish_chunk)
+
+def chunk_publisher(channel, message, header_frame, started, threadsafe=False):
+    """Return the callback publishing each streamed sentence, or None when streaming is off.
+
+    The indexes of the sentences that could not be published are kept in its `failed` list;
+    once one failed, the following ones are skipped, as the whole message will be retried.
+    """
+    if not OLLAMA_STREAM:
+        return None
+
+    failed = []
+
+    def send_chunk(sentence, headers, index, last):
+        if failed or not send_to_humanized_queue(channel, sentence, message, headers, (index, last)):
+            failed.append(index)
+
+    def publish_chunk(sentence, index, last):
+        logging.info(f"Humanized sentence {index}: {sentence}")
+        headers = trace_headers(header_frame, started=started, finished=now_ms())
+        publish = functools.partial(send_chunk, sentence, headers, index, last)
+        if threadsafe:
+            channel.connection.add_callback_threadsafe(publish)
+        else:
+            publish()
+
+    publish_chunk.failed = failed
+    return publish_chunk
+
+def consume_warnings(channel):
+    global warning_consumer_tag
+
+    warning_consumer_tag = channel.basic_consume(queue='000_notification_warning', on_message_callback=on_message_callback)
+
+def pause_warnings(channel):
+    """Stop taking warnings while an error is pending, so a warning backlog never delays errors.
+
+    Cancelling the consumer requeues the warnings pika received but did not dispatch yet.
+    """
+    global warning_consumer_tag
+
+    if warning_consumer_tag is not None:
+        channel.basic_cancel(warning_consumer_tag)
+        warning_consumer_tag = None
+        logging.info("Error received, warnings paused.")
+
+def resume_warnings(channel):
+    """Take warnings again once no error is being humanized or waiting in its queue."""
+    if warning_consumer_tag is not None or errors_in_flight:
+        return
+    if channel.queue_declare(queue='000_notification_error', passive=True).method.message_count == 0:
+        consume_warnings(channel)
+        logging.info("No error pending, warnings resumed.")
+
+def acknowledge(channel, delivery_tag, published):
+    """Ack a message whose result was published, or requeue it so it is not lost."""
+    if published:
+        channel.basic_ack(delivery_tag)
+    else:
+        logging.error(f"Message {delivery_tag} could not be published, requeueing it.")
+        channel.basic_nack(delivery_tag, requeue=True)
+
+    errors_in_flight.discard(delivery_tag)
+    resume_warnings(channel)
+
+def finish_message(channel, delivery_tag, message, text_humanized, headers, publish_chunk=None):
+    """Publish the result and acknowledge the message; runs on the connection thread."""
+    try:
+        if text_humanized and publish_chunk is not None and publish_chunk.failed:
+            logging.error(f"Sentence {publish_chunk.failed[0]} of the message could not be published: {message['text']}")
+            published = reprocess_message(channel, message, headers)
+        elif text_humanized:
+            logging.info(f"Humanized message: {text_humanized}")
+            # Streamed sentences were already published as they were generated
+            published = publish_chunk is not None or send_to_humanized_queue(channel, text_humanized, message, headers)
+        else:
+            logging.error(f"Failed to humanize the message: {message['text']}")
+            published = reprocess_message(channel, message, headers)
+
+        acknowledge(channel, delivery_tag, published)
+    except Exception as e:
+        logging.error(f"Error finishing message {delivery_tag}: {str(e)}")
+
+def humanize_in_worker(channel, delivery_tag, header_frame, message, started):
+    """Call Ollama on a worker thread, then hand the publish and ack back to the connection thread."""
+    publish_chunk = chunk_publisher(channel, message, header_frame, started, threadsafe=True)
+    try:
+        text_humanized = humanize_message(message, publish_chunk)
+    except Exception as e:
+        logging.error(f"Error humanizing message {delivery_tag}: {str(e)}")
+        text_humanized = ""
+
+    headers = trace_headers(header_frame, started=started, finished=now_ms())
+
+    try:
+        # pika channels are not thread safe, only the connection thread may use them
+        channel.connection.add_callback_threadsafe(
+            functools.partial(finish_message, channel, delivery_tag, message, text_humanized, headers, publish_chunk)
+        )
+    except Exception as e:
+        logging.error(f"Connection closed before message {delivery_tag} was finished, it will be redelivered: {str(e)}")
+
+def summarize_batch(batch):
+    """Humanize several messages with one summary request. Returns (summary message, text)."""
+    messages = [message for _, _, message, _ in batch]
+    summary = {
+        'text': "\n".join(message['text'] for message in messages),
+        'level': 'error' if any(message['level'] == 'error' for message in messages) else 'warning',
+        'originals': [{'text': message['text'], 'level': message['level']} for message in messages]
+    }
+
+    logging.info(f"Summarizing a batch of {len(messages)} messages.")
+    return summary, requestOllama(None, summary['level'], build_summary_prompt(messages))
+
+def finish_batch(channel, batch, summary, text_humanized):
+    """Publish the summary, or reprocess every message of the batch; runs on the connection thread."""
+    finished = now_ms()
+    try:
+        if text_humanized:
+            logging.info(f"Humanized summary of {len(batch)} messages: {text_humanized}")
+            # The summary carries the trace of the first message and the ids of all of them
+            headers = trace_headers(batch[0][1], started=min(started for _, _, _, started in batch), finished=finished)
+            headers['x-syrin-batched-message-ids'] = [
+                (header_frame.headers or {}).get('x-syrin-message-id') for _, header_frame, _, _ in batch
+                if header_frame is not None and (header_frame.headers or {}).get('x-syrin-message-id')
+            ]
+            published = send_to_humanized_queue(channel, text_humanized, summary, headers)
+            for delivery_tag, _, _, _ in batch:
+                acknowledge(channel, delivery_tag, published)
+        else:
+            logging.error(f"Failed to summarize a batch of {len(batch)} messages.")
+            for delivery_tag, header_frame, message, started in batch:
+                published = reprocess_message(channel, message, trace_headers(header_frame, started=started, finished=finished))
+                acknowledge(channel, delivery_tag, published)
+    except Exception as e:
+        logging.error(f"Error finishing a batch of {len(batch)} messages: {str(e)}")
+
+def summarize_in_worker(channel, batch):
+    try:
+        summary, text_humanized = summarize_batch(batch)
+    except Exception as e:
+        logging.error(f"Error summarizing a batch of {len(batch)} messages: {str(e)}")
+        summary, text_humanized = None, ""
+
+    try:
+        channel.connection.add_callback_threadsafe(functools.partial(finish_batch, channel, batch, summary, text_humanized))
+    except Exception as e:
+        logging.error(f"Connection closed before the batch was finished, it will be redelivered: {str(e)}")
+
+def process_message(channel, delivery_tag, header_frame, message, started):
+    if humanization_pool is not None:
+        humanization_pool.submit(humanize_in_worker, channel, delivery_tag, header_frame, message, started)
+        return
+
+    publish_chunk = chunk_publisher(channel, message, header_frame, started)
+    try:
+        text_humanized = humanize_message(message, publish_chunk)
+    except Exception as e:
+        logging.error(f"Error humanizing message {delivery_tag}: {str(e)}")
+        text_humanized = ""
+    headers = trace_headers(header_frame, started=started, finished=now_ms())
+    finish_message(channel, delivery_tag, message, text_humanized, headers, publish_chunk)
+
+def flush_batch(channel):
+    """Humanize the messages gathered so far, summarizing them when there is more than one."""
+    global humanization_batch, humanization_batch_timer
+
+    if humanization_batch_timer is not None:
+        channel.connection.remove_timeout(humanization_batch_timer)
+        humanization_batch_timer = None
+
+    batch, humanization_batch = humanization_batch, []
+    if len(batch) == 1:
+        process_message(channel, *batch[0])
+    elif batch and humanization_pool is not None:
+        humanization_pool.submit(summarize_in_worker, channel, batch)
+    elif batch:
+        try:
+            summary, text_humanized = summarize_batch(batch)
+        except Exception as e:
+            logging.error(f"Error summarizing a batch of {len(batch)} messages: {str(e)}")
+            summary, text_humanized = None, ""
+        finish_batch(channel, batch, summary, text_humanized)
+
+def on_batch_window_closed(channel):
+    global humanization_batch_timer
+
+    humanization_batch_timer = None
+    flush_batch(channel)
+
+def add_to_batch(channel, delivery_tag, header_frame, message, started):
+    global humanization_batch_timer
+
+    humanization_batch.append((delivery_tag, header_frame, message, started))
+    if len(humanization_batch) >= HUMANIZATION_BATCH_SIZE:
+        flush_batch(channel)
+    elif humanization_batch_timer is None:
+        # The window opens with the first message of the batch
+        humanization_batch_timer = channel.connection.call_later(HUMANIZATION_BATCH_WINDOW, functools.partial(on_batch_window_closed, channel))
 
 def on_message_callback(channel, method_frame, header_frame, body):
+    message = None
     try:
+        started = now_ms()
         message = json.loads(body.decode())
 
+        # Other producers may send numbers or null, the patterns and prompts need a string
+        if not isinstance(message.get('text'), str):
+            message['text'] = '' if message.get('text') is None else str(message['text'])
+
         logging.info(f"Message received from queue {method_frame.routing_key}: {message['text']}, {message['level']}")
-        text_humanized = requestOllama(message['text'], message['level'])
 
-        if text_humanized:
-            logging.info(f"Humanized message: {text_humanized}")
-            send_to_humanized_queue(channel, text_humanized, message)
+        # A blank text fails on every attempt, so it skips the retry tiers
+        if not message['text'].strip():
+            logging.error("The message has no text to humanize.")
+            acknowledge(channel, method_frame.delivery_tag, park_message(channel, message, trace_headers(header_frame)))
+            return
+
+        if method_frame.routing_key == '000_notification_error':
+            errors_in_flight.add(method_frame.delivery_tag)
+            pause_warnings(channel)
+
+        if HUMANIZATION_BATCH_SIZE > 1:
+            add_to_batch(channel, method_frame.delivery_tag, header_frame, message, started)
         else:
-            logging.error(f"Failed to humanize the message: {message['text']}")
-            reprocess_message(channel, message)
-        
-        # Acknowledge that the message was successfully processed
-        channel.basic_ack(method_frame.delivery_tag)
+            process_message(channel, method_frame.delivery_tag, header_frame, message, started)
     except Exception as e:
         logging.error(f"Error in callback processing message: {str(e)}")
-        channel.basic_ack(method_frame.delivery_tag)
+        # A body that cannot be decoded will never succeed, anything else is retried
+        if isinstance(message, dict) and message.get('level') in ('error', 'warning'):
+            acknowledge(channel, method_frame.delivery_tag, reprocess_message(channel, message, trace_headers(header_frame)))
+        else:
+            acknowledge(channel, method_frame.delivery_tag, True)
 
 def consume_messages():
     try:
@@ -173,23 +1078,28 @@ def consume_messages():
 
         channel = connection.channel()
 
-        # Declare all queues to ensure they exist before consuming
-        queues_to_declare = [
-            '000_notification_error',
-            '000_notification_warning',
-            '001_notification_process_humanized'
-        ]
+        # Declare the whole topology once, before consuming
+        queues_to_declare = {
+            '000_notification_error': PRIORITY_QUEUE_ARGUMENTS,
+            '000_notification_warning': PRIORITY_QUEUE_ARGUMENTS,
+            '001_notification_process_humanized': PRIORITY_QUEUE_ARGUMENTS
+        }
+        for level in ('error', 'warning'):
+            queues_to_declare.update(get_retry_queues(
+                f"001_notification_reprocess_humanized_{level}",
+                f"000_notification_{level}",
+                '001_notification_parked_humanized'
+            ))
 
-        for queue in queues_to_declare:
-            channel.queue_declare(queue=queue, durable=True)
-            logging.info(f"Queue '{queue}' checked or created.")
+        declare_topology(channel, queues_to_declare)
 
-        # Check or declare the reprocessing queue with TTL and DLX
-        declare_reprocess_queue(channel)
+        # Take only the messages being humanized (or batched) so the broker hands out the highest priority first
+        channel.basic_qos(prefetch_count=HUMANIZATION_CONCURRENCY * HUMANIZATION_BATCH_SIZE, global_qos=True)
 
-        # Register callback for error and warning queues
+        # Register callback for error and warning queues. Each 000 queue holds a single level, so
+        # errors go first by pausing the warning consumer while an error is pending
         channel.basic_consume(queue='000_notification_error', on_message_callback=on_message_callback)
-        channel.basic_consume(queue='000_notification_warning', on_message_callback=on_message_callback)
+        consume_warnings(channel)
 
         logging.info("Waiting for messages...")
 
@@ -205,6 +1115,16 @@ def consume_messages():
 if __name__ == "__main__":
     try:
         logging.info("Syrin text humanized - started \o/")
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT)
+        load_humanization_rules()
+        open_humanization_cache()
+        if OLLAMA_WARMUP:
+            warm_up_ollama()
+        if OLLAMA_HEALTH_INTERVAL > 0:
+            threading.Thread(target=health_check_loop, name="ollama-health", daemon=True).start()
+        if OLLAMA_KEEP_WARM_INTERVAL > 0:
+            threading.Thread(target=keep_warm_loop, name="keep-warm", daemon=True).start()
         consume_messages()
     except Exception as e:
         logging.error(f"Error running the application: {str(e)}")
@@ -1,12 +1,24 @@
 import os
+import io
+import re
+import uuid
 import pika
 import json
 import logging
+import time
+import random
+import hashlib
+import functools
+import threading
 import torch
 import shutil  # To delete files
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
 from minio import Minio
 from minio.error import S3Error
+from minio.commonconfig import CopySource
+from prometheus_client import Counter, start_http_server
 from TTS.api import TTS  # Coqui TTS Library
 
 # Set log level to INFO
@@ -18,8 +30,45 @@ logging.getLogger("pika").setLevel(logging.WARNING)
 # Check if CUDA is available (for GPU acceleration, if needed)
 use_cuda = torch.cuda.is_available()
 
+# Threads of the CPU inference (0 keeps the PyTorch default, one per core)
+TORCH_NUM_THREADS = int(os.getenv('TORCH_NUM_THREADS', 0))
+if TORCH_NUM_THREADS > 0:
+    torch.set_num_threads(TORCH_NUM_THREADS)
+
+# Batching: prefetch up to MAKE_AUDIO_BATCH_SIZE messages, waiting at most MAKE_AUDIO_BATCH_WINDOW
+# seconds after the first one, and synthesize them back to back on the warm model (1 disables it)
+MAKE_AUDIO_BATCH_SIZE = int(os.getenv('MAKE_AUDIO_BATCH_SIZE', 1))
+MAKE_AUDIO_BATCH_WINDOW = float(os.getenv('MAKE_AUDIO_BATCH_WINDOW', 0.5))  # seconds
+
+# Chunked mode: synthesize and publish long texts sentence by sentence, so playback starts after
+# the first sentence; sentences shorter than MAKE_AUDIO_CHUNK_MIN_CHARS are merged with the next one
+MAKE_AUDIO_CHUNKED = os.getenv('MAKE_AUDIO_CHUNKED', 'false').lower() == 'true'
+MAKE_AUDIO_CHUNK_MIN_CHARS = int(os.getenv('MAKE_AUDIO_CHUNK_MIN_CHARS', 20))
+
+# End of a sentence: punctuation (plus closing quotes or brackets) followed by whitespace, or a line break
+SENTENCE_END = re.compile(r'(?:[.!?…]+["\'”)\]]*\s+|\n+)(?=\S)')
+
+# Load TTS settings: model, reference voice and language of every synthesis
+TTS_MODEL_NAME = os.getenv('TTS_MODEL_NAME', 'tts_models/multilingual/multi-dataset/your_tts')
+TTS_SPEAKER_WAV = os.getenv('TTS_SPEAKER_WAV', '/app/veicaetano.wav')
+TTS_LANGUAGE = os.getenv('TTS_LANGUAGE', 'pt-br')
+
+# Speaker registry: voices as name=reference wav, comma separated (the first one is the default),
+# and the voice of each message level, e.g. error=caetano,warning=ana
+TTS_VOICES = OrderedDict(
+    (name.strip(), path.strip())
+    for name, path in (voice.split('=', 1) for voice in os.getenv('TTS_VOICES', f"default={TTS_SPEAKER_WAV}").split(',') if '=' in voice)
+)
+TTS_LEVEL_VOICES = dict(
+    (level.strip(), name.strip())
+    for level, name in (voice.split('=', 1) for voice in os.getenv('TTS_LEVEL_VOICES', '').split(',') if '=' in voice)
+)
+
+# Directory where the speaker embeddings are saved, by hash of model and reference wav (empty: memory only)
+SPEAKER_EMBEDDING_CACHE_PATH = os.getenv('SPEAKER_EMBEDDING_CACHE_PATH', '/app/cache/speakers')
+
 # Load the YourTTS model from Coqui (multilingual)
-tts = TTS(model_name="tts_models/multilingual/multi-dataset/your_tts", progress_bar=False, gpu=use_cuda)
+tts = TTS(model_name=TTS_MODEL_NAME, progress_bar=False, gpu=use_cuda)
 
 # Load RabbitMQ settings from environment variables
 rabbitmq_host = os.getenv('RABBITMQ_HOST', '')
@@ -28,8 +77,23 @@ rabbitmq_vhost = os.getenv('RABBITMQ_VHOST', '')
 rabbitmq_user = os.getenv('RABBITMQ_USER', '')
 rabbitmq_pass = os.getenv('RABBITMQ_PASS', '')
 
-# TTL and DLX settings for reprocessing
-rabbitmq_ttl_dlx = int(os.getenv('RABBITMQ_TTL_DLX', 60000))  # 60 seconds TTL (60000 ms)
+# Retry tiers: the n-th retry of a message waits for the n-th delay (the last one repeats),
+# spread over RABBITMQ_RETRY_JITTER_QUEUES queues with TTLs within +/- RABBITMQ_RETRY_JITTER,
+# and the message is parked after RABBITMQ_RETRY_MAX_ATTEMPTS
+rabbitmq_retry_delays = [int(delay) for delay in os.getenv('RABBITMQ_RETRY_DELAYS', '5000,30000,120000,600000').split(',') if delay.strip()]  # ms
+rabbitmq_retry_jitter = float(os.getenv('RABBITMQ_RETRY_JITTER', 0.2))
+rabbitmq_retry_jitter_queues = int(os.getenv('RABBITMQ_RETRY_JITTER_QUEUES', 5))  # queues per delay
+rabbitmq_retry_max_attempts = int(os.getenv('RABBITMQ_RETRY_MAX_ATTEMPTS', 10))  # 0 retries for ever
+if not rabbitmq_retry_delays or min(rabbitmq_retry_delays) <= 0:
+    raise ValueError(f"RABBITMQ_RETRY_DELAYS must list at least one positive delay in ms, got '{os.getenv('RABBITMQ_RETRY_DELAYS')}'")
+if rabbitmq_retry_jitter_queues < 1:
+    raise ValueError(f"RABBITMQ_RETRY_JITTER_QUEUES must be at least 1, got {rabbitmq_retry_jitter_queues}")
+
+# Priority queues: errors overtake warnings at every stage (0 disables priorities)
+rabbitmq_max_priority = int(os.getenv('RABBITMQ_MAX_PRIORITY', 10))
+
+# Arguments of the processing queues, identical in every Syrin service
+PRIORITY_QUEUE_ARGUMENTS = {'x-max-priority': rabbitmq_max_priority} if rabbitmq_max_priority > 0 else None
 
 # Load MinIO settings from environment variables
 MINIO_URL = os.getenv('MINIO_URL', '')
@@ -38,6 +102,45 @@ MINIO_ROOT_USER = os.getenv('MINIO_ROOT_USER', '')
 MINIO_ROOT_PASSWORD = os.getenv('MINIO_ROOT_PASSWORD', '')
 MINIO_BUCKET_WORK = os.getenv('MINIO_BUCKET_WORK', 'syrin')
 
+# Prefix of the audios reused by the REST API audio cache
+AUDIO_CACHE_PREFIX = os.getenv('AUDIO_CACHE_PREFIX', 'cache/')
+
+# Content-addressed synthesis cache: audios stored by hash of text, speaker, language and model
+SYNTHESIS_CACHE_ENABLED = os.getenv('SYNTHESIS_CACHE_ENABLED', 'true').lower() == 'true'
+SYNTHESIS_CACHE_PREFIX = os.getenv('SYNTHESIS_CACHE_PREFIX', 'synthesis/')
+SYNTHESIS_CACHE_TTL = int(os.getenv('SYNTHESIS_CACHE_TTL', 604800))  # seconds since the audio was synthesized
+SYNTHESIS_CACHE_MAX_OBJECTS = int(os.getenv('SYNTHESIS_CACHE_MAX_OBJECTS', 10000))
+SYNTHESIS_CACHE_SWEEP_INTERVAL = int(os.getenv('SYNTHESIS_CACHE_SWEEP_INTERVAL', 3600))  # seconds, 0 disables eviction
+SYNTHESIS_CACHE_INDEX_SIZE = int(os.getenv('SYNTHESIS_CACHE_INDEX_SIZE', 10000))  # entries kept in memory
+
+# Port of the Prometheus metrics endpoint (0 disables it)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9103))
+
+# Messages waiting for the batch window to close: (delivery tag, header frame, message, started)
+make_audio_batch = []
+make_audio_batch_timer = None
+
+# Batches are synthesized on a single worker thread, in order, so the connection thread keeps
+# sending heartbeats during long syntheses
+synthesis_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='synthesis')
+
+# Seconds the synthesis worker waits for the connection thread to publish a chunk
+CHUNK_PUBLISH_TIMEOUT = 30
+
+# Uploads to MinIO overlap with the synthesis of the next messages of a batch
+upload_pool = ThreadPoolExecutor(max_workers=max(MAKE_AUDIO_BATCH_SIZE, 1), thread_name_prefix='upload')
+
+# Speaker embeddings registered in the model, by voice name
+speaker_embeddings = {}
+
+# Cached audios known to exist, least recently used first: key -> (object name, expiry epoch)
+synthesis_cache_index = OrderedDict()
+synthesis_cache_lock = threading.Lock()
+
+# Prometheus metrics of the make-audio agent
+SYNTHESIS_CACHE_LOOKUPS = Counter('syrin_make_audio_synthesis_cache_lookups_total', 'Synthesis cache lookups', ['result'])
+SYNTHESIS_CACHE_EVICTIONS = Counter('syrin_make_audio_synthesis_cache_evictions_total', 'Cached audios deleted from MinIO', ['reason'])
+
 # Connect to MinIO
 minio_client = Minio(
     f"{MINIO_URL}:{MINIO_PORT}",
@@ -46,18 +149,19 @@ minio_client = Minio(
     secure=False
 )
 
-# Function to upload the file to MinIO
-def upload_to_minio(file_path, file_name):
+# Function to upload the audio buffer to MinIO
+def upload_to_minio(audio, file_name):
     try:
         # Check if the bucket exists, if not, create it
         if not minio_client.bucket_exists(MINIO_BUCKET_WORK):
             minio_client.make_bucket(MINIO_BUCKET_WORK)
         
-        # Upload the file
-        minio_client.fput_object(
+        # Upload straight from memory, without a temporary file
+        minio_client.put_object(
             MINIO_BUCKET_WORK, 
             file_name, 
-            file_path,
+            audio,
+            length=audio.getbuffer().nbytes,
             content_type="audio/wav"
         )
         logging.info(f"File {file_name} uploaded to bucket {MINIO_BUCKET_WORK} on MinIO.")
@@ -66,49 +170,280 @@ def upload_to_minio(file_path, file_name):
         logging.error(f"Error uploading file to MinIO: {str(e)}")
         return False
 
-def delete_local_file(file_path):
+def get_priority(level):
+    """Map the message level to an AMQP priority."""
+    if rabbitmq_max_priority <= 0:
+        return None
+    return rabbitmq_max_priority if level == 'error' else 1
+
+def now_ms():
+    """Epoch timestamp in milliseconds, as used in the x-syrin-* trace headers."""
+    return int(time.time() * 1000)
+
+def trace_headers(header_frame, **timestamps):
+    """Copy the correlation headers of the incoming message and add this stage's timestamps."""
+    headers = dict(header_frame.headers or {}) if header_frame is not None else {}
+    for event, value in timestamps.items():
+        headers[f"x-syrin-make-audio-{event}"] = value
+    return headers
+
+def store_in_audio_cache(file_name, cache_key):
+    """Copy the uploaded audio to the REST API audio cache (server-side, no upload)."""
+    cached_name = f"{AUDIO_CACHE_PREFIX}{cache_key}.wav"
     try:
-        os.remove(file_path)
-        logging.info(f"Local file {file_path} successfully deleted.")
+        minio_client.copy_object(MINIO_BUCKET_WORK, cached_name, CopySource(MINIO_BUCKET_WORK, file_name))
+        logging.info(f"File {file_name} stored in the audio cache as {cached_name}.")
+    except S3Error as e:
+        logging.error(f"Error storing {file_name} in the audio cache: {str(e)}")
+
+@functools.lru_cache(maxsize=None)
+def get_speaker_id(speaker_wav):
+    """Hash of the reference voice, so replacing the file invalidates the audios cached with it."""
+    try:
+        with open(speaker_wav, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
     except OSError as e:
-        logging.error(f"Error deleting local file: {file_path} - {str(e)}")
+        logging.error(f"Error reading the speaker reference {speaker_wav}: {str(e)}")
+        return speaker_wav
+
+def get_synthesis_key(text, voice):
+    """Content address of a synthesis: hash of the text, speaker, language and model."""
+    return hashlib.sha256(f"{TTS_MODEL_NAME}\n{TTS_LANGUAGE}\n{get_speaker_id(TTS_VOICES[voice])}\n{text}".encode()).hexdigest()
+
+def get_voice(level):
+    """Voice of the message level, or the default (first) voice of the registry."""
+    voice = TTS_LEVEL_VOICES.get(level)
+    return voice if voice in TTS_VOICES else next(iter(TTS_VOICES))
+
+def load_speaker_embedding(speaker_wav):
+    """Embedding of a reference voice, read from the disk cache or computed once and saved."""
+    embedding_id = hashlib.sha256(f"{TTS_MODEL_NAME}\n{get_speaker_id(speaker_wav)}".encode()).hexdigest()
+    cache_file = os.path.join(SPEAKER_EMBEDDING_CACHE_PATH, f"{embedding_id}.json") if SPEAKER_EMBEDDING_CACHE_PATH else None
+
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading the speaker embedding {cache_file}, computing it again: {str(e)}")
+
+    embedding = tts.synthesizer.tts_model.speaker_manager.compute_embedding_from_clip(speaker_wav)
+
+    if cache_file:
+        try:
+            os.makedirs(SPEAKER_EMBEDDING_CACHE_PATH, exist_ok=True)
+            with open(cache_file, 'w') as f:
+                json.dump(embedding, f)
+        except OSError as e:
+            logging.error(f"Error saving the speaker embedding {cache_file}: {str(e)}")
+    return embedding
 
-def publish_to_start_queue(channel, message):
+def load_speaker_registry():
+    """Register the embedding of every voice in the model, so syntheses skip the reference audio."""
+    for voice, speaker_wav in TTS_VOICES.items():
+        try:
+            embedding = load_speaker_embedding(speaker_wav)
+            # YourTTS looks named speakers up here and averages their embeddings
+            tts.synthesizer.tts_model.speaker_manager.embeddings_by_names[voice] = [embedding]
+            speaker_embeddings[voice] = embedding
+            logging.info(f"Voice '{voice}' registered from {speaker_wav}.")
+        except Exception as e:
+            logging.error(f"Error registering voice '{voice}' from {speaker_wav}, its embedding will be computed on every synthesis: {str(e)}")
+
+def remember_synthesis(key, object_name, expires):
+    """Put an entry in the in-memory index; must be called with synthesis_cache_lock held."""
+    synthesis_cache_index[key] = (object_name, expires)
+    synthesis_cache_index.move_to_end(key)
+    while len(synthesis_cache_index) > SYNTHESIS_CACHE_INDEX_SIZE:
+        synthesis_cache_index.popitem(last=False)
+
+def lookup_synthesis(key):
+    """Return the MinIO object name of the cached audio, or None if it must be synthesized."""
+    now = time.time()
+
+    with synthesis_cache_lock:
+        entry = synthesis_cache_index.get(key)
+        if entry and entry[1] > now:
+            synthesis_cache_index.move_to_end(key)
+            SYNTHESIS_CACHE_LOOKUPS.labels(result='index_hit').inc()
+            return entry[0]
+        synthesis_cache_index.pop(key, None)
+
+    object_name = f"{SYNTHESIS_CACHE_PREFIX}{key}.wav"
+    try:
+        stat = minio_client.stat_object(MINIO_BUCKET_WORK, object_name)
+        expires = stat.last_modified.timestamp() + SYNTHESIS_CACHE_TTL
+        if expires > now:
+            with synthesis_cache_lock:
+                remember_synthesis(key, object_name, expires)
+            SYNTHESIS_CACHE_LOOKUPS.labels(result='minio_hit').inc()
+            return object_name
+    except S3Error as e:
+        if e.code != 'NoSuchKey':
+            logging.error(f"Error checking cached audio {object_name} on MinIO: {str(e)}")
+    except Exception as e:
+        logging.error(f"Error checking cached audio {object_name} on MinIO: {str(e)}")
+
+    SYNTHESIS_CACHE_LOOKUPS.labels(result='miss').inc()
+    return None
+
+def store_synthesis(file_name, key):
+    """Copy the uploaded audio to its content address (server-side, no upload)."""
+    object_name = f"{SYNTHESIS_CACHE_PREFIX}{key}.wav"
+    try:
+        minio_client.copy_object(MINIO_BUCKET_WORK, object_name, CopySource(MINIO_BUCKET_WORK, file_name))
+        with synthesis_cache_lock:
+            remember_synthesis(key, object_name, time.time() + SYNTHESIS_CACHE_TTL)
+        logging.info(f"File {file_name} stored in the synthesis cache as {object_name}.")
+    except S3Error as e:
+        logging.error(f"Error storing {file_name} in the synthesis cache: {str(e)}")
+
+def sweep_synthesis_cache():
+    """Delete the cached audios older than the TTL, then the oldest ones above the size limit."""
+    now = datetime.now(timezone.utc)
+    objects = sorted(
+        (item.last_modified, item.object_name)
+        for item in minio_client.list_objects(MINIO_BUCKET_WORK, prefix=SYNTHESIS_CACHE_PREFIX, recursive=True)
+    )
+    expired = sum(1 for modified, _ in objects if (now - modified).total_seconds() > SYNTHESIS_CACHE_TTL)
+    evicted = max(expired, len(objects) - SYNTHESIS_CACHE_MAX_OBJECTS)
+
+    for index, (_, object_name) in enumerate(objects[:evicted]):
+        minio_client.remove_object(MINIO_BUCKET_WORK, object_name)
+        SYNTHESIS_CACHE_EVICTIONS.labels(reason='expired' if index < expired else 'size').inc()
+        with synthesis_cache_lock:
+            synthesis_cache_index.pop(object_name[len(SYNTHESIS_CACHE_PREFIX):-len('.wav')], None)
+
+    if evicted:
+        logging.info(f"Synthesis cache sweep deleted {evicted} of {len(objects)} cached audio(s), {expired} expired.")
+
+def synthesis_cache_sweep_loop():
+    while True:
+        try:
+            sweep_synthesis_cache()
+        except Exception as e:
+            logging.error(f"Error sweeping the synthesis cache: {str(e)}")
+        time.sleep(SYNTHESIS_CACHE_SWEEP_INTERVAL)
+
+def publish_to_start_queue(channel, message, headers=None):
+    """Publish the message to speak. Returns False if it could not be published."""
     try:
         queue = '003_notification_process_play_audio'
-        channel.queue_declare(queue=queue, durable=True)
+        if headers is not None:
+            headers['x-syrin-make-audio-enqueued'] = now_ms()
         channel.basic_publish(
             exchange='',
             routing_key=queue,
             body=json.dumps(message, ensure_ascii=False),
-            properties=pika.BasicProperties(delivery_mode=2)
+            properties=pika.BasicProperties(delivery_mode=2, priority=get_priority(message.get('level')), headers=headers)
         )
         logging.info(f"Message published to queue {queue}: {message}")
+        return True
     except Exception as e:
         logging.error(f"Error publishing message to queue {queue}: {str(e)}")
+        return False
 
-def publish_to_reprocess_queue(channel, message):
-    try:
-        # Declare the reprocessing queue with TTL and DLX
-        channel.queue_declare(
-            queue='002_notification_reprocess_make_audio',
-            durable=True,
-            arguments={
-                'x-message-ttl': rabbitmq_ttl_dlx,  # Configurable TTL (1 minute)
-                'x-dead-letter-exchange': '',  # Default DLX to route to another queue
-                'x-dead-letter-routing-key': '001_notification_process_humanized'  # Queue where the message will be moved
+def get_delay_label(delay):
+    """Readable suffix of a retry queue: 5s, 30s, 2m, 1500ms..."""
+    if delay % 60000 == 0:
+        return f"{delay // 60000}m"
+    if delay % 1000 == 0:
+        return f"{delay // 1000}s"
+    return f"{delay}ms"
+
+# Queues declared at startup with their arguments; publishers never declare on the hot path
+declared_queues = {}
+
+def get_retry_tier(retry_prefix, delay):
+    """Queues of one retry delay with their TTL, spread evenly over delay +/- RABBITMQ_RETRY_JITTER.
+
+    RabbitMQ only expires messages at the head of a queue, so a per-message expiration would wait
+    for the longest one queued ahead. Every message of these queues has the queue's TTL instead.
+    """
+    if rabbitmq_retry_jitter_queues == 1 or not rabbitmq_retry_jitter:
+        spreads = [0.0]
+    else:
+        spreads = [rabbitmq_retry_jitter * (2 * index / (rabbitmq_retry_jitter_queues - 1) - 1) for index in range(rabbitmq_retry_jitter_queues)]
+    return [(f"{retry_prefix}_{get_delay_label(delay)}_{index + 1}", max(int(delay * (1 + spread)), 1)) for index, spread in enumerate(spreads)]
+
+def get_retry_queues(retry_prefix, destination, parking_queue):
+    """Retry tier queues of a stage, dead-lettering to the destination, plus its parking queue."""
+    queues = {parking_queue: None}
+    for delay in rabbitmq_retry_delays:
+        for queue, ttl in get_retry_tier(retry_prefix, delay):
+            queues[queue] = {
+                'x-message-ttl': ttl,
+                'x-dead-letter-exchange': '',  # Default exchange
+                'x-dead-letter-routing-key': destination  # Queue where expired messages are moved
             }
+    return queues
+
+def declare_topology(channel, queues):
+    """Declare every queue once and remember it for the publishers.
+
+    Declaring an existing queue with other arguments makes RabbitMQ close the channel
+    (PRECONDITION_FAILED), so a topology that does not match stops the service at startup
+    instead of losing messages later.
+    """
+    for queue, arguments in queues.items():
+        try:
+            channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            logging.error(f"Queue '{queue}' exists with arguments other than {arguments}: {str(e)}")
+            raise
+        declared_queues[queue] = arguments
+        logging.info(f"Queue '{queue}' checked or created.")
+
+def ensure_declared(queue):
+    """Fail before publishing to a queue missing from the topology, which would drop the message."""
+    if queue not in declared_queues:
+        raise KeyError(f"Queue '{queue}' is not part of the declared topology")
+
+def schedule_retry(channel, message, headers, retry_prefix, destination, parking_queue, stage):
+    """Send a failed message to the retry tier of its attempt, or park it after the last attempt.
+
+    Each tier is a set of queues without consumers, declared at startup by get_retry_queues, that
+    dead-letter expired messages back to the destination queue. Picking one of them at random
+    adds the jitter, so retries do not come back in synchronized waves. Returns the queue the
+    message was published to, and raises when it could not be published.
+    """
+    headers = dict(headers or {})
+    attempt = int(headers.get(f"x-syrin-{stage}-retries", 0)) + 1
+    headers[f"x-syrin-{stage}-retries"] = attempt
+
+    if rabbitmq_retry_max_attempts and attempt > rabbitmq_retry_max_attempts:
+        queue = parking_queue
+        properties = pika.BasicProperties(delivery_mode=2, priority=get_priority(message.get('level')), headers=headers)
+        logging.error(f"Message still failing after {attempt - 1} retries, parked in '{queue}'.")
+    else:
+        delay = rabbitmq_retry_delays[min(attempt, len(rabbitmq_retry_delays)) - 1]
+        queue, ttl = random.choice(get_retry_tier(retry_prefix, delay))
+        properties = pika.BasicProperties(
+            delivery_mode=2,  # Persist the message
+            priority=get_priority(message.get('level')),  # Kept when the message is dead-lettered
+            headers=headers
         )
-        # Publish the message to the reprocessing queue
-        channel.basic_publish(
-            exchange='',
-            routing_key='002_notification_reprocess_make_audio',
-            body=json.dumps(message, ensure_ascii=False),
-            properties=pika.BasicProperties(delivery_mode=2)
+        logging.info(f"Retry {attempt} scheduled in {ttl} ms through '{queue}'.")
+
+    ensure_declared(queue)
+    channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(message, ensure_ascii=False), properties=properties)
+    return queue
+
+def publish_to_reprocess_queue(channel, message, headers=None):
+    """Send the message to its retry tier. Returns False if it could not be published."""
+    try:
+        schedule_retry(
+            channel, message, headers,
+            retry_prefix='002_notification_reprocess_make_audio',
+            destination='001_notification_process_humanized',
+            parking_queue='002_notification_parked_make_audio',
+            stage='make-audio'
         )
-        logging.info(f"Message sent to reprocessing queue: {message['humanized_text']}")
+        logging.info(f"Message sent to reprocessing queue: {message.get('humanized_text')}")
+        return True
     except Exception as e:
         logging.error(f"Error sending message to reprocessing queue: {str(e)}")
+        return False
 
 def connect_to_rabbitmq():
     try:
@@ -133,59 +468,314 @@ def connect_to_rabbitmq():
         logging.error(f"Error connecting to RabbitMQ: {str(e)}")
         return None
 
-def tts_make(txt):
+def tts_make(txt, voice):
+    """Synthesize the text into an in-memory WAV. Returns (file name, buffer)."""
     try:
-        # Create the filedateprocess variable with date and time in format DD_MM_YYYY_HH_MM_SS
-        filedateprocess = datetime.now().strftime('%d_%m_%Y_%H_%M_%S')
+        # Date and time in format DD_MM_YYYY_HH_MM_SS, plus a random suffix so names never collide
+        file_name = f"{datetime.now().strftime('%d_%m_%Y_%H_%M_%S')}_{uuid.uuid4().hex[:12]}.wav"
 
-        output_path = f"/tmp/{filedateprocess}.wav"
+        # Generate the audio, from the registered embedding when there is one
+        if voice in speaker_embeddings:
+            wav = tts.tts(text=txt, speaker=voice, language=TTS_LANGUAGE)
+        else:
+            wav = tts.tts(text=txt, speaker_wav=TTS_VOICES[voice], language=TTS_LANGUAGE)
 
-        # Generate the audio file
-        tts.tts_to_file(
-            text=txt,
-            speaker_wav="/app/veicaetano.wav",
-            language="pt-br",
-            file_path=output_path
-        )
+        audio = io.BytesIO()
+        tts.synthesizer.save_wav(wav, audio)
+        audio.seek(0)
 
-        return filedateprocess, output_path
+        return file_name, audio
     except Exception as e:
         logging.error(f"Error generating audio: {str(e)}")
         return None, None
 
-def on_message_callback(channel, method_frame, header_frame, body):
+def upload_in_worker(audio, file_name):
+    """Upload from the upload pool; returns (uploaded, finished timestamp)."""
+    return upload_to_minio(audio, file_name), now_ms()
+
+def split_sentences(text):
+    """Split the text into sentences of at least MAKE_AUDIO_CHUNK_MIN_CHARS characters."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if match.end() - start >= MAKE_AUDIO_CHUNK_MIN_CHARS:
+            sentences.append(text[start:match.end()].strip())
+            start = match.end()
+
+    rest = text[start:].strip()
+    if rest and sentences and len(rest) < MAKE_AUDIO_CHUNK_MIN_CHARS:
+        sentences[-1] = f"{sentences[-1]} {rest}"
+    elif rest:
+        sentences.append(rest)
+    return sentences
+
+def finish_chunk(channel, chunk, headers, synthesis_key, file_name, upload):
+    """Publish a chunk once its audio is in MinIO. Returns False if the upload or the publish failed."""
+    if upload is None:
+        # Found in the synthesis cache
+        chunk['cached'] = True
+        headers['x-syrin-make-audio-finished'] = headers['x-syrin-make-audio-synthesized']
+    else:
+        uploaded, headers['x-syrin-make-audio-finished'] = upload.result()
+        if not uploaded:
+            return False
+        if synthesis_key:
+            store_synthesis(file_name, synthesis_key)
+
+    chunk['filename'] = file_name
+
+    # Wait for the publish, so an unpublished chunk is retried with the rest of the text
     try:
-        message = json.loads(body.decode())
+        published = hand_over(channel, None, chunk, headers).result(timeout=CHUNK_PUBLISH_TIMEOUT)
+    except FutureTimeoutError:
+        logging.error(f"Chunk {chunk['chunk_index']} was not published within {CHUNK_PUBLISH_TIMEOUT}s.")
+        published = False
 
-        logging.info(f"Message received from queue {method_frame.routing_key}: {message['humanized_text']}, Level: {message['level']}")
+    if not published and upload is not None:
+        try:
+            minio_client.remove_object(MINIO_BUCKET_WORK, file_name)
+        except Exception as e:
+            logging.error(f"Error deleting unpublished chunk {file_name} from MinIO: {str(e)}")
+    return published
+
+def discard_chunk(chunk):
+    """Drop a chunk that will not be published: cancel its upload, or delete the uploaded audio."""
+    if chunk is None or chunk[4] is None:
+        return
+    upload = chunk[4]
+    if upload.cancel():
+        return
+    uploaded, _ = upload.result()
+    if uploaded:
+        try:
+            minio_client.remove_object(MINIO_BUCKET_WORK, chunk[3])
+            logging.info(f"Deleted unpublished chunk {chunk[3]} from MinIO.")
+        except Exception as e:
+            logging.error(f"Error deleting unpublished chunk {chunk[3]} from MinIO: {str(e)}")
+
+def reprocess_remaining(channel, delivery_tag, message, headers, sentences, index):
+    """Retry the sentences not published yet as a single last chunk, so played ones are not repeated."""
+    rest = dict(message, humanized_text=' '.join(sentences[index:]), chunk_index=index, chunk_last=True)
+    rest.pop('cache_key', None)
+    logging.error(f"Chunk {index} of '{message['humanized_text']}' failed. Sending the remaining {len(sentences) - index} sentence(s) to reprocessing.")
+    hand_over(channel, delivery_tag, rest, headers, reprocess=True)
+
+def synthesize_chunks(channel, delivery_tag, header_frame, message, started, voice, sentences):
+    """Synthesize and publish the message sentence by sentence, in order.
+
+    The first sentence is published as soon as it is uploaded, so speak starts playing it while
+    the rest is synthesized; each following sentence uploads while the next one is synthesized.
+    """
+    pending = None  # previous chunk, waiting for its upload
+    failed = None  # index of the first sentence that could not be published
+
+    for index, sentence in enumerate(sentences):
+        chunk = dict(message, humanized_text=sentence, chunk_index=index, chunk_last=index == len(sentences) - 1)
+        chunk.pop('cache_key', None)  # the REST API audio cache keeps whole texts only
+
+        synthesis_key = get_synthesis_key(sentence, voice) if SYNTHESIS_CACHE_ENABLED else None
+        cached_name = lookup_synthesis(synthesis_key) if synthesis_key else None
+        if cached_name:
+            current = (chunk, trace_headers(header_frame, started=started, synthesized=now_ms()), synthesis_key, cached_name, None)
+        else:
+            file_name, audio = tts_make(sentence, voice)
+            headers = trace_headers(header_frame, started=started, synthesized=now_ms())
+            current = (chunk, headers, synthesis_key, file_name, upload_pool.submit(upload_in_worker, audio, file_name)) if file_name and audio else None
+
+        if pending is not None and not finish_chunk(channel, *pending):
+            failed = index - 1
+            # This sentence is retried with the rest, its audio is not needed
+            discard_chunk(current)
+            break
+        pending = current
+        if current is None:
+            failed = index
+            break
+        if index == 0:
+            # Nothing is playing yet: publish the first sentence without waiting for the second one
+            if not finish_chunk(channel, *pending):
+                failed = 0
+                break
+            pending = None
+    else:
+        if pending is not None and not finish_chunk(channel, *pending):
+            failed = len(sentences) - 1
+
+    if failed is not None:
+        reprocess_remaining(channel, delivery_tag, message, trace_headers(header_frame, started=started), sentences, failed)
+    else:
+        logging.info(f"Message synthesized in {len(sentences)} chunk(s): {message['humanized_text']}")
+        hand_over(channel, delivery_tag, None, None)
+
+def synthesize_message(channel, delivery_tag, header_frame, message, started):
+    """Answer the message from the synthesis cache, or synthesize it and start its upload.
+
+    Returns the pending upload (delivery tag, message, headers, synthesis key, file name, future),
+    or None when the message was already published or sent to reprocessing.
+    """
+    voice = get_voice(message['level'])
+
+    # Long texts are split into sentences, unless humanization already streamed them one by one
+    if MAKE_AUDIO_CHUNKED and 'chunk_index' not in message:
+        sentences = split_sentences(message['humanized_text'])
+        if len(sentences) > 1:
+            synthesize_chunks(channel, delivery_tag, header_frame, message, started, voice, sentences)
+            return None
+
+    # Identical sentences are played from the synthesis cache without running TTS
+    synthesis_key = get_synthesis_key(message['humanized_text'], voice) if SYNTHESIS_CACHE_ENABLED else None
+    cached_name = lookup_synthesis(synthesis_key) if synthesis_key else None
+    if cached_name:
+        logging.info(f"Synthesis cache hit for '{message['humanized_text']}': {cached_name}")
+        headers = trace_headers(header_frame, started=started, synthesized=now_ms())
+        headers['x-syrin-make-audio-finished'] = headers['x-syrin-make-audio-synthesized']
+        message['filename'] = cached_name
+        message['cached'] = True  # speak keeps cached audios in the bucket
+        if message.get('cache_key'):
+            store_in_audio_cache(cached_name, message['cache_key'])
+        hand_over(channel, delivery_tag, message, headers)
+        return None
+
+    # Send the text to the tts_make function
+    file_name, audio = tts_make(message['humanized_text'], voice)
+    headers = trace_headers(header_frame, started=started, synthesized=now_ms())
+
+    if not (file_name and audio):
+        # Failure in generating audio, send to reprocessing queue
+        logging.error(f"Error processing message: {message['humanized_text']}. Audio file was not generated.")
+        hand_over(channel, delivery_tag, message, headers, reprocess=True)
+        return None
+
+    # Upload while the next message of the batch is synthesized
+    return delivery_tag, message, headers, synthesis_key, file_name, upload_pool.submit(upload_in_worker, audio, file_name)
+
+def finish_upload(channel, delivery_tag, message, headers, synthesis_key, file_name, upload):
+    uploaded, headers['x-syrin-make-audio-finished'] = upload.result()
+    if uploaded:
+        # Increment the filename field
+        message['filename'] = file_name
 
-        # Send the text to the tts_make function
-        filedateprocess, output_path = tts_make(message['humanized_text'])
+        # Keep a copy for the next identical alert
+        if message.get('cache_key'):
+            store_in_audio_cache(message['filename'], message['cache_key'])
+        if synthesis_key:
+            store_synthesis(message['filename'], synthesis_key)
 
-        if filedateprocess and output_path:
-            # Try to upload the file to MinIO
-            if upload_to_minio(output_path, f"{filedateprocess}.wav"):
-                # Delete the local file after successful upload
-                delete_local_file(output_path)
+        # Publish the incremented message to the process_notification_start queue and ack it
+        hand_over(channel, delivery_tag, message, headers)
+    else:
+        # Failure in uploading, send to reprocessing queue
+        logging.error(f"Failed to publish generated audio. Sending to reprocessing queue.")
+        hand_over(channel, delivery_tag, message, headers, reprocess=True)
 
-                # Increment the filename field
-                message['filename'] = f"{filedateprocess}.wav"
+def finish_message(channel, delivery_tag, message, headers, reprocess, result):
+    """Publish the message (to speak, or to reprocessing) and acknowledge it; runs on the connection thread.
 
-                # Publish the incremented message to the process_notification_start queue
-                publish_to_start_queue(channel, message)
+    Without a message only the ack is sent; without a delivery tag only the message is published.
+    A message that could not be published is requeued instead of acknowledged. The result future
+    is set to whether the message was published.
+    """
+    published = False
+    try:
+        if reprocess:
+            published = publish_to_reprocess_queue(channel, message, headers)
+        elif message is not None:
+            published = publish_to_start_queue(channel, message, headers)
+        else:
+            published = True
 
-                # Acknowledge that the message has been processed and removed from the original queue
-                channel.basic_ack(method_frame.delivery_tag)
-            else:
-                # Failure in uploading, send to reprocessing queue
-                logging.error(f"Failed to publish generated audio. Sending to reprocessing queue.")
-                publish_to_reprocess_queue(channel, message)
-                channel.basic_ack(method_frame.delivery_tag)  # Acknowledge that the message has been processed
+        if delivery_tag is None:
+            pass
+        elif published:
+            channel.basic_ack(delivery_tag)
         else:
-            # Failure in generating audio, send to reprocessing queue
-            logging.error(f"Error processing message: {message['humanized_text']}. Audio file was not generated.")
-            publish_to_reprocess_queue(channel, message)
-            channel.basic_ack(method_frame.delivery_tag)  # Acknowledge that the message has been processed
+            logging.error(f"Message {delivery_tag} could not be published, requeueing it.")
+            channel.basic_nack(delivery_tag, requeue=True)
+    except Exception as e:
+        logging.error(f"Error finishing message {delivery_tag}: {str(e)}")
+    finally:
+        result.set_result(published)
+
+def hand_over(channel, delivery_tag, message, headers, reprocess=False):
+    """Hand a publish and/or ack from the synthesis worker back to the connection thread.
+
+    Returns a future telling whether the message was published.
+    """
+    result = Future()
+    try:
+        # pika channels are not thread safe, only the connection thread may use them
+        channel.connection.add_callback_threadsafe(
+            functools.partial(finish_message, channel, delivery_tag, message, headers, reprocess, result)
+        )
+    except Exception as e:
+        logging.error(f"Connection closed before message {delivery_tag} was finished, it will be redelivered: {str(e)}")
+        result.set_result(False)
+    return result
+
+def process_batch(channel, batch):
+    """Synthesize the messages back to back on the warm model, then publish and ack each one.
+
+    Runs on the synthesis worker. Uploads run in the upload pool while the following messages
+    are synthesized; a failing message is sent to reprocessing on its own without affecting
+    the rest of the batch.
+    """
+    pending = []
+    for delivery_tag, header_frame, message, started in batch:
+        try:
+            upload = synthesize_message(channel, delivery_tag, header_frame, message, started)
+            if upload:
+                pending.append(upload)
+        except Exception as e:
+            logging.error(f"Error synthesizing message {delivery_tag}: {str(e)}")
+            hand_over(channel, delivery_tag, message, trace_headers(header_frame, started=started), reprocess=True)
+
+    for upload in pending:
+        try:
+            finish_upload(channel, *upload)
+        except Exception as e:
+            logging.error(f"Error finishing message {upload[4]}: {str(e)}")
+            hand_over(channel, upload[0], upload[1], upload[2], reprocess=True)
+
+    if len(batch) > 1:
+        logging.info(f"Batch of {len(batch)} message(s) processed in {now_ms() - batch[0][3]} ms.")
+
+def flush_batch(channel):
+    """Process the messages gathered so far."""
+    global make_audio_batch, make_audio_batch_timer
+
+    if make_audio_batch_timer is not None:
+        channel.connection.remove_timeout(make_audio_batch_timer)
+        make_audio_batch_timer = None
+
+    batch, make_audio_batch = make_audio_batch, []
+    if batch:
+        synthesis_pool.submit(process_batch, channel, batch)
+
+def on_batch_window_closed(channel):
+    global make_audio_batch_timer
+
+    make_audio_batch_timer = None
+    flush_batch(channel)
+
+def on_message_callback(channel, method_frame, header_frame, body):
+    global make_audio_batch_timer
+
+    try:
+        started = now_ms()
+        message = json.loads(body.decode())
+
+        logging.info(f"Message received from queue {method_frame.routing_key}: {message['humanized_text']}, Level: {message['level']}")
+
+        if MAKE_AUDIO_BATCH_SIZE <= 1:
+            synthesis_pool.submit(process_batch, channel, [(method_frame.delivery_tag, header_frame, message, started)])
+            return
+
+        make_audio_batch.append((method_frame.delivery_tag, header_frame, message, started))
+        if len(make_audio_batch) >= MAKE_AUDIO_BATCH_SIZE:
+            flush_batch(channel)
+        elif make_audio_batch_timer is None:
+            # The window opens with the first message of the batch
+            make_audio_batch_timer = channel.connection.call_later(MAKE_AUDIO_BATCH_WINDOW, functools.partial(on_batch_window_closed, channel))
     except Exception as e:
         logging.error(f"Error in callback processing message: {str(e)}")
         channel.basic_ack(method_frame.delivery_tag)
@@ -199,24 +789,21 @@ def consume_messages():
 
         channel = connection.channel()
 
-        # Declare the queues to ensure they exist
-        queues_to_declare = [
-            '001_notification_process_humanized',
+        # Declare the whole topology once, before consuming
+        queues_to_declare = {
+            '001_notification_process_humanized': PRIORITY_QUEUE_ARGUMENTS,
+            '003_notification_process_play_audio': PRIORITY_QUEUE_ARGUMENTS,
+        }
+        queues_to_declare.update(get_retry_queues(
             '002_notification_reprocess_make_audio',
-            '003_notification_process_play_audio',
-        ]
-
-        for queue in queues_to_declare:
-            channel.queue_declare(
-                queue=queue, 
-                durable=True,
-                arguments={
-                    'x-message-ttl': rabbitmq_ttl_dlx,
-                    'x-dead-letter-exchange': '',
-                    'x-dead-letter-routing-key': '001_notification_process_humanized'
-                } if queue == '002_notification_reprocess_make_audio' else None
-            )
-            logging.info(f"Queue '{queue}' checked or created.")
+            '001_notification_process_humanized',
+            '002_notification_parked_make_audio'
+        ))
+
+        declare_topology(channel, queues_to_declare)
+
+        # Take only the messages of one batch so the broker hands out the highest priority first
+        channel.basic_qos(prefetch_count=max(MAKE_AUDIO_BATCH_SIZE, 1))
 
         # Register the callback for the queue '001_notification_process_humanized'
         channel.basic_consume(queue='001_notification_process_humanized', on_message_callback=on_message_callback)
@@ -235,6 +822,11 @@ def consume_messages():
 if __name__ == "__main__":
     try:
         logging.info("Syrin TTS Make Audio - started \o/")
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT)
+        load_speaker_registry()
+        if SYNTHESIS_CACHE_ENABLED and SYNTHESIS_CACHE_SWEEP_INTERVAL > 0:
+            threading.Thread(target=synthesis_cache_sweep_loop, name="synthesis-cache-sweep", daemon=True).start()
         consume_messages()
     except Exception as e:
         logging.error(f"Error running the application: {str(e)}")
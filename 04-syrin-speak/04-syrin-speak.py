@@ -2,7 +2,10 @@ import os
 import pika
 import json
 import logging
+import time
+import random
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from minio import Minio
 from minio.error import S3Error
 import sounddevice as sd
@@ -22,8 +25,26 @@ rabbitmq_vhost = os.getenv('RABBITMQ_VHOST', '')
 rabbitmq_user = os.getenv('RABBITMQ_USER', '')
 rabbitmq_pass = os.getenv('RABBITMQ_PASS', '')
 
-# Load delay time between checks from environment variables
-rabbitmq_ttl_dlx = int(os.getenv('RABBITMQ_TTL_DLX', 60000))  # 60 seconds TTL (60000 ms)
+# Retry tiers: the n-th retry of a message waits for the n-th delay (the last one repeats),
+# spread over RABBITMQ_RETRY_JITTER_QUEUES queues with TTLs within +/- RABBITMQ_RETRY_JITTER,
+# and the message is parked after RABBITMQ_RETRY_MAX_ATTEMPTS
+rabbitmq_retry_delays = [int(delay) for delay in os.getenv('RABBITMQ_RETRY_DELAYS', '5000,30000,120000,600000').split(',') if delay.strip()]  # ms
+rabbitmq_retry_jitter = float(os.getenv('RABBITMQ_RETRY_JITTER', 0.2))
+rabbitmq_retry_jitter_queues = int(os.getenv('RABBITMQ_RETRY_JITTER_QUEUES', 5))  # queues per delay
+rabbitmq_retry_max_attempts = int(os.getenv('RABBITMQ_RETRY_MAX_ATTEMPTS', 10))  # 0 retries for ever
+if not rabbitmq_retry_delays or min(rabbitmq_retry_delays) <= 0:
+    raise ValueError(f"RABBITMQ_RETRY_DELAYS must list at least one positive delay in ms, got '{os.getenv('RABBITMQ_RETRY_DELAYS')}'")
+if rabbitmq_retry_jitter_queues < 1:
+    raise ValueError(f"RABBITMQ_RETRY_JITTER_QUEUES must be at least 1, got {rabbitmq_retry_jitter_queues}")
+
+# Messages delivered ahead of the one playing; 2 keeps the next chunk of a sentence-chunked audio ready
+rabbitmq_prefetch_count = int(os.getenv('RABBITMQ_PREFETCH_COUNT', 1))
+
+# Priority queues: errors overtake warnings at every stage (0 disables priorities)
+rabbitmq_max_priority = int(os.getenv('RABBITMQ_MAX_PRIORITY', 10))
+
+# Arguments of the processing queues, identical in every Syrin service
+PRIORITY_QUEUE_ARGUMENTS = {'x-max-priority': rabbitmq_max_priority} if rabbitmq_max_priority > 0 else None
 
 # Load MinIO settings from environment variables
 MINIO_URL = os.getenv('MINIO_URL', '127.0.0.1')
@@ -40,6 +61,26 @@ minio_client = Minio(
     secure=False
 )
 
+# Archives played chunks off the consumer thread, so the next chunk starts right away
+archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+
+def get_priority(level):
+    """Map the message level to an AMQP priority."""
+    if rabbitmq_max_priority <= 0:
+        return None
+    return rabbitmq_max_priority if level == 'error' else 1
+
+def now_ms():
+    """Epoch timestamp in milliseconds, as used in the x-syrin-* trace headers."""
+    return int(time.time() * 1000)
+
+def trace_headers(header_frame, **timestamps):
+    """Copy the correlation headers of the incoming message and add this stage's timestamps."""
+    headers = dict(header_frame.headers or {}) if header_frame is not None else {}
+    for event, value in timestamps.items():
+        headers[f"x-syrin-speak-{event}"] = value
+    return headers
+
 # Function to download the file from MinIO
 def download_from_minio(file_name, output_path):
     try:
@@ -146,17 +187,37 @@ def play_audio(output_path):
         logging.error(f"Error playing audio: {str(e)}")
         return False
 
+def archive_chunk(file_name, output_path):
+    """Move a played chunk to "reproduced"; failures are only logged, a played sentence is never replayed."""
+    if upload_to_minio(file_name, output_path, "reproduced"):
+        delete_from_minio(file_name)
+    delete_local_file(output_path)
+
 # Function to download, play, upload, and delete the local and bucket file
-def process_audio(file_name, channel, message):
+def process_audio(file_name, channel, message, headers=None):
+    """Play the audio and archive it; failures go to the reprocessing queue.
+
+    Returns False only when a failed message could not be sent to reprocessing either.
+    """
+    headers = {} if headers is None else headers
+    published = True
     try:
-        output_path = f"/tmp/{file_name}"
+        output_path = f"/tmp/{os.path.basename(file_name)}"
 
         # Download the audio file from MinIO
         if download_from_minio(file_name, output_path):
+            headers['x-syrin-speak-downloaded'] = now_ms()
             # Play the audio
             if play_audio(output_path):
+                headers['x-syrin-speak-played'] = now_ms()
+                if message.get('cached'):
+                    # Audios from the REST API audio cache are reused, keep them in the bucket
+                    delete_local_file(output_path)
+                elif message.get('chunk_last') is False:
+                    # More sentences of the same text follow, play them back to back
+                    archive_pool.submit(archive_chunk, file_name, output_path)
                 # Upload to the "reproduced" subfolder
-                if upload_to_minio(file_name, output_path, "reproduced"):
+                elif upload_to_minio(file_name, output_path, "reproduced"):
                     # Delete the local file after successful upload
                     delete_local_file(output_path)
                     # Delete the original file from MinIO after successful upload
@@ -164,57 +225,137 @@ def process_audio(file_name, channel, message):
                 else:
                     logging.error(f"Failed to upload file {file_name} to MinIO.")
                     # Publish to reprocessing queue
-                    publish_to_reprocess_queue(channel, message)
+                    published = publish_to_reprocess_queue(channel, message, headers)
             else:
                 logging.error(f"Failed to play audio {file_name}.")
                 delete_local_file(output_path)  # Delete the local file even if playback fails
                 # Publish to reprocessing queue
-                publish_to_reprocess_queue(channel, message)
+                published = publish_to_reprocess_queue(channel, message, headers)
         else:
             logging.error(f"Failed to download file {file_name} from MinIO.")
             # Publish to reprocessing queue
-            publish_to_reprocess_queue(channel, message)
+            published = publish_to_reprocess_queue(channel, message, headers)
     except Exception as e:
         logging.error(f"Error processing audio {file_name}: {str(e)}")
         # Publish to reprocessing queue in case of general error
-        publish_to_reprocess_queue(channel, message)
+        published = publish_to_reprocess_queue(channel, message, headers)
+
+    return published
 
-def publish_to_reproduced_queue(channel, message):
+def publish_to_reproduced_queue(channel, message, headers=None):
     try:
         queue = '004_notification_process_audio_reproduced'
-        channel.queue_declare(queue=queue, durable=True)
         channel.basic_publish(
             exchange='',
             routing_key=queue,
             body=json.dumps(message, ensure_ascii=False),
-            properties=pika.BasicProperties(delivery_mode=2)
+            properties=pika.BasicProperties(delivery_mode=2, headers=headers)
         )
         logging.info(f"Message published to queue {queue}: {message}")
     except Exception as e:
         logging.error(f"Error publishing message to queue {queue}: {str(e)}")
 
-def publish_to_reprocess_queue(channel, message):
-    try:
-        # Declare the reprocessing queue with TTL and DLX
-        channel.queue_declare(
-            queue='003_notification_reprocess_play_audio',
-            durable=True,
-            arguments={
-                'x-message-ttl': rabbitmq_ttl_dlx,  # TTL configurable via environment variable
-                'x-dead-letter-exchange': '',  # Default DLX to route to another queue
-                'x-dead-letter-routing-key': '003_notification_process_play_audio'  # Queue to move the message to
+def get_delay_label(delay):
+    """Readable suffix of a retry queue: 5s, 30s, 2m, 1500ms..."""
+    if delay % 60000 == 0:
+        return f"{delay // 60000}m"
+    if delay % 1000 == 0:
+        return f"{delay // 1000}s"
+    return f"{delay}ms"
+
+# Queues declared at startup with their arguments; publishers never declare on the hot path
+declared_queues = {}
+
+def get_retry_tier(retry_prefix, delay):
+    """Queues of one retry delay with their TTL, spread evenly over delay +/- RABBITMQ_RETRY_JITTER.
+
+    RabbitMQ only expires messages at the head of a queue, so a per-message expiration would wait
+    for the longest one queued ahead. Every message of these queues has the queue's TTL instead.
+    """
+    if rabbitmq_retry_jitter_queues == 1 or not rabbitmq_retry_jitter:
+        spreads = [0.0]
+    else:
+        spreads = [rabbitmq_retry_jitter * (2 * index / (rabbitmq_retry_jitter_queues - 1) - 1) for index in range(rabbitmq_retry_jitter_queues)]
+    return [(f"{retry_prefix}_{get_delay_label(delay)}_{index + 1}", max(int(delay * (1 + spread)), 1)) for index, spread in enumerate(spreads)]
+
+def get_retry_queues(retry_prefix, destination, parking_queue):
+    """Retry tier queues of a stage, dead-lettering to the destination, plus its parking queue."""
+    queues = {parking_queue: None}
+    for delay in rabbitmq_retry_delays:
+        for queue, ttl in get_retry_tier(retry_prefix, delay):
+            queues[queue] = {
+                'x-message-ttl': ttl,
+                'x-dead-letter-exchange': '',  # Default exchange
+                'x-dead-letter-routing-key': destination  # Queue where expired messages are moved
             }
+    return queues
+
+def declare_topology(channel, queues):
+    """Declare every queue once and remember it for the publishers.
+
+    Declaring an existing queue with other arguments makes RabbitMQ close the channel
+    (PRECONDITION_FAILED), so a topology that does not match stops the service at startup
+    instead of losing messages later.
+    """
+    for queue, arguments in queues.items():
+        try:
+            channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            logging.error(f"Queue '{queue}' exists with arguments other than {arguments}: {str(e)}")
+            raise
+        declared_queues[queue] = arguments
+        logging.info(f"Queue '{queue}' checked or created.")
+
+def ensure_declared(queue):
+    """Fail before publishing to a queue missing from the topology, which would drop the message."""
+    if queue not in declared_queues:
+        raise KeyError(f"Queue '{queue}' is not part of the declared topology")
+
+def schedule_retry(channel, message, headers, retry_prefix, destination, parking_queue, stage):
+    """Send a failed message to the retry tier of its attempt, or park it after the last attempt.
+
+    Each tier is a set of queues without consumers, declared at startup by get_retry_queues, that
+    dead-letter expired messages back to the destination queue. Picking one of them at random
+    adds the jitter, so retries do not come back in synchronized waves. Returns the queue the
+    message was published to, and raises when it could not be published.
+    """
+    headers = dict(headers or {})
+    attempt = int(headers.get(f"x-syrin-{stage}-retries", 0)) + 1
+    headers[f"x-syrin-{stage}-retries"] = attempt
+
+    if rabbitmq_retry_max_attempts and attempt > rabbitmq_retry_max_attempts:
+        queue = parking_queue
+        properties = pika.BasicProperties(delivery_mode=2, priority=get_priority(message.get('level')), headers=headers)
+        logging.error(f"Message still failing after {attempt - 1} retries, parked in '{queue}'.")
+    else:
+        delay = rabbitmq_retry_delays[min(attempt, len(rabbitmq_retry_delays)) - 1]
+        queue, ttl = random.choice(get_retry_tier(retry_prefix, delay))
+        properties = pika.BasicProperties(
+            delivery_mode=2,  # Persist the message
+            priority=get_priority(message.get('level')),  # Kept when the message is dead-lettered
+            headers=headers
         )
-        # Publish the message to the reprocessing queue
-        channel.basic_publish(
-            exchange='',
-            routing_key='003_notification_reprocess_play_audio',
-            body=json.dumps(message, ensure_ascii=False),
-            properties=pika.BasicProperties(delivery_mode=2)
+        logging.info(f"Retry {attempt} scheduled in {ttl} ms through '{queue}'.")
+
+    ensure_declared(queue)
+    channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(message, ensure_ascii=False), properties=properties)
+    return queue
+
+def publish_to_reprocess_queue(channel, message, headers=None):
+    """Send the message to its retry tier. Returns False if it could not be published."""
+    try:
+        schedule_retry(
+            channel, message, headers,
+            retry_prefix='003_notification_reprocess_play_audio',
+            destination='003_notification_process_play_audio',
+            parking_queue='003_notification_parked_play_audio',
+            stage='speak'
         )
-        logging.info(f"Message sent to reprocessing queue: {message['filename']}")
+        logging.info(f"Message sent to reprocessing queue: {message.get('filename')}")
+        return True
     except Exception as e:
         logging.error(f"Error sending message to reprocessing queue: {str(e)}")
+        return False
 
 def connect_to_rabbitmq():
     try:
@@ -239,23 +380,35 @@ def connect_to_rabbitmq():
         logging.error(f"Error connecting to RabbitMQ: {str(e)}")
         return None
 
+def requeue(channel, delivery_tag):
+    """Give a message that could not be sent to reprocessing back to its queue instead of losing it."""
+    logging.error(f"Message {delivery_tag} could not be sent to reprocessing, requeueing it.")
+    channel.basic_nack(delivery_tag, requeue=True)
+
 def on_message_callback(channel, method_frame, header_frame, body):
+    headers = trace_headers(header_frame, started=now_ms())
+    message = None
     try:
         message = json.loads(body.decode())
         logging.info(f"Message received from queue 003_notification_process_play_audio: File: {message['filename']}")
 
         # Process the audio: download, play, upload, and delete locally
-        process_audio(message['filename'], channel, message)
+        if not process_audio(message['filename'], channel, message, headers):
+            requeue(channel, method_frame.delivery_tag)
+            return
 
         # Publish the item to the process_notification_reproduced queue after success
-        publish_to_reproduced_queue(channel, message)
+        headers['x-syrin-speak-finished'] = now_ms()
+        publish_to_reproduced_queue(channel, message, headers)
 
         # Remove the message from queue 003_notification_process_play_audio
         channel.basic_ack(method_frame.delivery_tag)
     except Exception as e:
         logging.error(f"Error in callback while processing message: {str(e)}")
-        # Send to reprocessing queue if an error occurs
-        publish_to_reprocess_queue(channel, message)
+        # Send to reprocessing queue if an error occurs; a body that cannot be decoded is dropped
+        if isinstance(message, dict) and not publish_to_reprocess_queue(channel, message, headers):
+            requeue(channel, method_frame.delivery_tag)
+            return
         channel.basic_ack(method_frame.delivery_tag)
 
 def consume_messages():
@@ -267,24 +420,21 @@ def consume_messages():
 
         channel = connection.channel()
 
-        # Declare the queues to ensure they exist
-        queues_to_declare = [
-            '003_notification_process_play_audio',
+        # Declare the whole topology once, before consuming
+        queues_to_declare = {
+            '003_notification_process_play_audio': PRIORITY_QUEUE_ARGUMENTS,
+            '004_notification_process_audio_reproduced': None
+        }
+        queues_to_declare.update(get_retry_queues(
             '003_notification_reprocess_play_audio',
-            '004_notification_process_audio_reproduced'
-        ]
-
-        for queue in queues_to_declare:
-            channel.queue_declare(
-                queue=queue, 
-                durable=True,
-                arguments={
-                    'x-message-ttl': rabbitmq_ttl_dlx,
-                    'x-dead-letter-exchange': '',
-                    'x-dead-letter-routing-key': '003_notification_process_play_audio'
-                } if queue == '003_notification_reprocess_play_audio' else None
-            )
-            logging.info(f"Queue '{queue}' checked or created.")
+            '003_notification_process_play_audio',
+            '003_notification_parked_play_audio'
+        ))
+
+        declare_topology(channel, queues_to_declare)
+
+        # One message at a time lets the broker hand out the highest priority first
+        channel.basic_qos(prefetch_count=rabbitmq_prefetch_count)
 
         # Register the callback to consume messages
         channel.basic_consume(queue='003_notification_process_play_audio', on_message_callback=on_message_callback)